@@ -1,32 +1,51 @@
 import numpy as np
+import hashlib
+import factors_sparse
 
 # This is code to run factors in numpy.
 # The class is fairly simple, just contains:
 # 1. the array which has the values at each possible combination of variables. One dimension for each variable.
 # 		e.g [[0.2,0.4]
 #			 [0.1,0.3]]
-# 2. the index which has the index of each combination of variables. This is a 2d array which lists all possible variable combinations.
+# 2. the names of each variable e.g ["A","B"]
+# 3. the index which has the index of each combination of variables. This is a 2d array which lists all possible variable combinations.
 # 		e.g [[0,0]
 #			 [0,1]
 #			 [1,0]
 #			 [1,1]]
-# 3. the names of each variable e.g ["A","B"]
 # The reason for having the index is it makes it easier to edit values and easier to print the factor.
+# The index is bigger than the array itself, so it is only made the first time something reads factor.indexes.
+# Factors made in the middle of inference are never printed, so they never pay for it.
+# A factor can also hold a fingerprint of its contents (see fingerprint below), which is forgotten whenever
+# the values are changed with set, set_all or by giving it a new array.
+# Finally, log says whether the array holds probabilities or log probabilities (see LOG SPACE below).
 
 class Factor:
+	__slots__ = ["names","_array","_indexes","_fingerprint","log"]
+
 	def __init__(self,names,pos_values):
-		array = np.zeros((pos_values))
-		indexes = np.zeros((np.prod(array.shape),len(names))).astype(int)
-		f = 1
-		for i in range(len(names)):
-			# fills the given column in the indexes
-			repeated = np.arange(array.shape[i]).repeat(np.prod(array.shape)/(f*array.shape[i]))
-			indexes[:,i]=np.tile(repeated,f)
-			f = f*array.shape[i]
 		self.names = names
-		self.array = array
-		self.indexes = indexes
-		
+		self.array = np.zeros((pos_values))
+		self._indexes = None
+		self.log = False
+
+	@property
+	def array(self):
+		return self._array
+
+	@array.setter
+	def array(self,array):
+		self._array = array
+		self._fingerprint = None
+
+	# builds the index the first time it is needed (or again if the array was swapped for one with a different shape).
+	@property
+	def indexes(self):
+		shape = self.array.shape
+		if(self._indexes is None or self._indexes.shape!=(int(np.prod(shape)),len(shape))):
+			self._indexes = np.indices(shape).reshape(len(shape),int(np.prod(shape))).T
+		return self._indexes
+
 	# show the array in a nice format.
 	def __repr__(self):
 		array = self.array
@@ -35,7 +54,7 @@ class Factor:
 		name_lengths = [len(str(n)) for n in names]
 		formatter = "".join(["{:<"+str(l+2)+"}" for l in name_lengths])+"{}"
 		strings = []
-		strings.append(formatter.format(*(names+["Values (10 dp)"])))
+		strings.append(formatter.format(*(list(names)+[("Log values" if self.log else "Values")+" (10 dp)"])))
 		for i in range(indexes.shape[0]):
 			val = array[tuple(indexes[i])].round(10)
 			strings.append(formatter.format(*(list(indexes[i])+[val])))
@@ -46,6 +65,7 @@ class Factor:
 		ndim = len(self.names)
 		if(len(index)==ndim):
 			self.array[tuple(index)]=value
+			self._fingerprint = None
 		else:
 			raise Exception('length of index is incorrect. Provide {} values'.format(ndim))
 
@@ -63,47 +83,157 @@ class Factor:
 		return new_factor
 	
 	def copy(self):
-		new_factor = Factor(self.names,list(self.array.shape))
-		new_factor.set_all(self.array.reshape(-1))
-		return new_factor
+		return from_array(self.names,self.array.copy(),self.log)
+
+# makes a factor straight from an array (one dimension per name) without making a zero array first.
+# The factor takes the array as it is, it isn't copied.
+def from_array(names,array,log=False):
+	new_factor = Factor.__new__(Factor)
+	new_factor.names = names
+	new_factor.array = array
+	new_factor._indexes = None
+	new_factor.log = log
+	return new_factor
+
+# LOG SPACE
+# Multiplying lots of probabilities together underflows to 0. In log space a factor holds log probabilities instead:
+# product becomes a sum, marginalize becomes a logsumexp and condition becomes a subtraction.
+# Every operation below takes log=None/True/False. None means: use log space if it is switched on for everything
+# (set_log_space(True)) or if any factor given is already in log space. True or False forces it either way.
+# Factors are moved into the right space before the operation, and the answer comes back in that space.
+
+LOG_SPACE = False
+
+def set_log_space(on=True):
+	global LOG_SPACE
+	LOG_SPACE = on
+
+# whether an operation on these factors should be done in log space.
+def use_log(log,*all_factors):
+	if(log==None):
+		return LOG_SPACE or any([f.log for f in all_factors])
+	return log
+
+def to_log(factor):
+	if(factor.log):
+		return factor
+	factor = factors_sparse.to_dense(factor)
+	with np.errstate(divide="ignore"):
+		return from_array(factor.names,np.log(factor.array),True)
+
+def to_linear(factor):
+	if(not factor.log):
+		return factor
+	return from_array(factor.names,np.exp(factor.array))
+
+def to_space(factor,log):
+	return to_log(factor) if log else to_linear(factor)
+
+# log(sum(exp(array))) over the axes, without exp overflowing/underflowing. Gives -inf where everything is -inf.
+def logsumexp(array,axis=None,keepdims=False):
+	largest = np.max(array,axis=axis,keepdims=True)
+	largest = np.where(np.isfinite(largest),largest,0)
+	with np.errstate(divide="ignore"):
+		summed = np.log(np.sum(np.exp(array-largest),axis=axis,keepdims=keepdims))
+	if(not keepdims):
+		largest = np.squeeze(largest,axis=axis)
+	return summed+largest
+
+# FINGERPRINTS
+# A short string which is the same for two factors with the same names, shape and values.
+# Used as a cache key (see factors_inference.InferenceCache). Hashing the array is only done once, the fingerprint is
+# kept until the factor changes through set, set_all or a new array. Changing the array in place
+# (e.g factor.array[0]=1) can't be seen, so use set for factors which are cached.
+def fingerprint(factor):
+	if(factor._fingerprint==None):
+		if(is_sparse(factor)):
+			# sparse factors are hashed by their entries (coords then values), so the same table stored sparse and dense differs.
+			content = hashlib.blake2b(np.ascontiguousarray(factor.coords).tobytes()+np.ascontiguousarray(factor.values).tobytes(),digest_size=16).hexdigest()
+			factor._fingerprint = hash_key((list(factor.names),factor.shape,"sparse",factor.values.dtype.str,content))
+			return factor._fingerprint
+		array = np.ascontiguousarray(factor.array)
+		content = hashlib.blake2b(array.tobytes(),digest_size=16).hexdigest()
+		factor._fingerprint = hash_key((list(factor.names),array.shape,array.dtype.str,factor.log,content))
+	return factor._fingerprint
+
+# hashes any key made of python values (lists, tuples, strings, numbers) down to a short string.
+def hash_key(key):
+	return hashlib.blake2b(repr(key).encode(),digest_size=16).hexdigest()
+
+# gives a factor made from other factors a fingerprint built from how it was made, rather than hashing its array.
+def set_fingerprint(factor,key):
+	factor._fingerprint = hash_key(key)
+	return factor
 		
+# Sparse factors (see factors_sparse) are handed over to the sparse versions of the functions below.
+def is_sparse(factor):
+	return isinstance(factor,factors_sparse.SparseFactor)
+
 # There are four major pieces of code to know:
 
 # 1. FACTOR CONDITIONING
 # 		returns the same factor but ensures the sum is 1 along a given set of axes.	
-def condition(factor,axis="none"):
+#		Slices which sum to 0 can't be normalized. zero_sums="nan" fills them with nan (what dividing by 0 would give),
+#		zero_sums="uniform" fills them with a uniform distribution instead.
+#		in_place=True reuses the array of the factor given rather than making a new one (and returns that same factor).
+def condition(factor,axis="none",zero_sums="nan",in_place=False,log=None):
+	log = use_log(log,factor)
+	if(not log and is_sparse(factor)):
+		return factors_sparse.condition(factor,axis,zero_sums,in_place)
+	if(log!=factor.log):
+		factor = to_space(factor,log)
+		in_place = False
 	array = factor.array
-	indexes = factor.indexes
 	names = factor.names
 	# if axis is none, then normalize the whole array so the total probability is 1.
 	if(axis=="none" or len(axis)==0):
-		new_factor = Factor(names,array.shape)
-		new_factor.set_all(array/np.sum(array))
-		return new_factor
+		sum_var_index = list(range(len(names)))
 	else:
 		cond_var_index = [a for a in range(len(names)) if names[a] in axis]
 		if(len(cond_var_index)<1):
 			print("Error: couldn't find variable")
 			return None
+		# find all variables not in the axis list, these are the ones the sum is taken over.
+		sum_var_index = [b for b in range(len(names)) if not b in cond_var_index]
+	# the sums keep their axes (size 1) so they broadcast straight back over the array.
+	out = None
+	if(in_place and np.issubdtype(array.dtype,np.floating)):
+		out = array
+	if(log):
+		sums = logsumexp(array,axis=tuple(sum_var_index),keepdims=True)
+		zero = (sums==-np.inf)
+		normalized_array = np.subtract(array,np.where(zero,0,sums),out=out)
+	else:
+		sums = np.sum(array,axis=tuple(sum_var_index),keepdims=True)
+		zero = (sums==0)
+		normalized_array = np.divide(array,np.where(zero,1,sums),out=out)
+	if(zero.any()):
+		if(zero_sums=="uniform"):
+			fill = 1/np.prod([array.shape[b] for b in sum_var_index])
+			if(log):
+				fill = np.log(fill)
+		elif(zero_sums=="nan"):
+			fill = np.nan
 		else:
-			# find all variables not in the axis list and get their sum. This is easy in numpy. 
-			# Gets the array created by summing out variables not in the axis list.
-			not_cond_var_index = [b for b in range(len(names)) if not b in cond_var_index]
-			sums = np.sum(array,axis=tuple(not_cond_var_index))
-			# make a new factor which is the same but divided by the normalization.
-			new_factor = Factor(names,array.shape)
-			for i in range(indexes.shape[0]):
-				norm = sums[tuple(indexes[i,cond_var_index])]
-				new_factor.set(indexes[i],array[tuple(indexes[i])]/norm)
-			return new_factor
+			raise Exception('zero_sums must be "nan" or "uniform", not {}'.format(zero_sums))
+		normalized_array[np.broadcast_to(zero,array.shape)] = fill
+	if(in_place):
+		factor.array = normalized_array
+		return factor
+	return from_array(names,normalized_array,log)
 
 # 2. FACTOR MARGINALIZATION
 # 		returns a smaller factor, taking the expectation over all variables in axis
-def marginalize(factor,axis="none"):
+def marginalize(factor,axis="none",log=None):
+	log = use_log(log,factor)
+	if(not log and is_sparse(factor)):
+		return factors_sparse.marginalize(factor,axis)
+	factor = to_space(factor,log)
 	array = factor.array
-	indexes = factor.indexes
 	names = factor.names
 	if(axis=="none" or len(axis)==len(factor.names)):
+		if(log):
+			return np.float64(logsumexp(array))
 		return np.sum(array)
 	else:
 		marg_var_index = [a for a in np.arange(len(names)) if names[a] in axis]
@@ -112,17 +242,25 @@ def marginalize(factor,axis="none"):
 		else:
 			# fairly simple, just sum out the variables in the axis list.
 			not_marg_var_index = [b for b in range(len(names)) if not b in marg_var_index]
-			summed_array = np.sum(array,axis=tuple(marg_var_index))
+			if(log):
+				summed_array = logsumexp(array,axis=tuple(marg_var_index))
+			else:
+				summed_array = np.sum(array,axis=tuple(marg_var_index))
 			new_names = [names[n] for n in not_marg_var_index]
-			new_factor = Factor(new_names,summed_array.shape)
-			new_factor.set_all(summed_array)
-			return new_factor
+			return from_array(new_names,summed_array,log)
 
 # 3. FACTOR PRODUCT
-# 		returns a joined factor. Most complicated piece of code here. Book gives good visualization.
+# 		returns a joined factor. Book gives good visualization.
 #		for each variable in factor1 which is not also in factor2 it needs to go through every option in factor2.
+#		Rather than looping over every option, both arrays are lined up by variable name (factor2 is transposed into the
+#		order of the new names and given size 1 axes for the variables it doesn't have) and numpy broadcasting does the multiply.
 
-def product(factor1,factor2):
+def product(factor1,factor2,log=None):
+	log = use_log(log,factor1,factor2)
+	if(not log and (is_sparse(factor1) or is_sparse(factor2))):
+		return factors_sparse.product(factor1,factor2)
+	factor1 = to_space(factor1,log)
+	factor2 = to_space(factor2,log)
 	names1 = factor1.names
 	names2 = factor2.names
 	# find variables both in factor 1 and 2
@@ -130,16 +268,17 @@ def product(factor1,factor2):
 	# get a list of all variables which will be in the new factor
 	new_names = names1 + [n for n in names2 if not n in joint_names]
 	from_2_to_new_index = [new_names.index(n) for n in names2]
-	factor2_not_joint_index = [n for n in range(len(names2)) if not names2[n] in joint_names]
-	# get the shape of the new array. Essentially adding new dimensions to factor1
-	new_shapes = list(factor1.array.shape)+[factor2.array.shape[n] for n in factor2_not_joint_index]
-	new_factor = Factor(new_names,new_shapes)
-	# every option in the new factor is the value in both factors with their respective variables multiplied.
-	for i in new_factor.indexes:
-		f1_part = i[:len(names1)]
-		f2_part = i[from_2_to_new_index]
-		new_factor.set(i,factor1.get(f1_part)*factor2.get(f2_part))
-	return new_factor
+	# factor1 just needs size 1 axes on the end for the variables it doesn't have.
+	array1 = factor1.array.reshape(factor1.array.shape+(1,)*(len(new_names)-len(names1)))
+	# factor2 has its axes sorted into the new order, then gets size 1 axes wherever it doesn't have the variable.
+	array2 = np.transpose(factor2.array,np.argsort(from_2_to_new_index))
+	broadcast_shape = [1]*len(new_names)
+	for n in range(len(names2)):
+		broadcast_shape[from_2_to_new_index[n]] = factor2.array.shape[n]
+	array2 = array2.reshape(broadcast_shape)
+	if(log):
+		return from_array(new_names,array1+array2,True)
+	return from_array(new_names,array1*array2)
 
 # 4. DROP VARIABLES
 #		selects a variables at particular values. 
@@ -150,8 +289,9 @@ def product(factor1,factor2):
 #		[0.1,0.3] (1d now instead of 2d)
 
 def drop_variables(factor,axis,values):
+	if(is_sparse(factor)):
+		return factors_sparse.drop_variables(factor,axis,values)
 	array = factor.array
-	indexes = factor.indexes
 	names = factor.names
 	var_index = [a for a in np.arange(len(names)) if names[a] in axis]
 	if(len(var_index)<1):
@@ -165,28 +305,134 @@ def drop_variables(factor,axis,values):
 			slc[var_index[v_i]]=slice(values[axis.index(names[var_index[v_i]])],values[axis.index(names[var_index[v_i]])]+1)
 		sliced_array = np.squeeze(array[tuple(slc)])
 		new_names = [names[n] for n in not_var_index]
-		new_factor = Factor(new_names,sliced_array.shape)
-		new_factor.set_all(sliced_array) # squeeze removes all axes with 1 dim.
-		return new_factor
+		return from_array(new_names,sliced_array.copy(),factor.log) # squeeze removes all axes with 1 dim.
 
 # simple code to do factor multiplication for a list of factors
-def multiple_factor_product(all_factors):
-	joint_factor = all_factors[0]
+# With order="greedy" (the default) the pair of factors whose product is smallest is multiplied first, over and over,
+# so how the list happens to be ordered doesn't decide how big the factors along the way get.
+# order="given" multiplies strictly left to right. Either way the answer has its names in the left to right order.
+def multiple_factor_product(all_factors,log=None,order="greedy"):
+	log = use_log(log,*all_factors)
+	joint_factor = to_space(all_factors[0],log)
 	if(len(all_factors)==1):
 		return joint_factor
-	for i in range(1,len(all_factors)):
-		joint_factor = product(joint_factor,all_factors[i])
-	return joint_factor
+	if(order=="given" or len(all_factors)==2):
+		for i in range(1,len(all_factors)):
+			joint_factor = product(joint_factor,all_factors[i],log)
+		return joint_factor
+	remaining = list(all_factors)
+	while(len(remaining)>1):
+		pairs = [(i,j) for i in range(len(remaining)) for j in range(i+1,len(remaining))]
+		sizes = [product_size([remaining[i],remaining[j]]) for i,j in pairs]
+		i,j = pairs[int(np.argmin(sizes))]
+		joint_factor = product(remaining[i],remaining[j],log)
+		remaining = [remaining[k] for k in range(len(remaining)) if k!=i and k!=j]+[joint_factor]
+	return reorder(remaining[0],product_names(all_factors))
+
+# the names the product of these factors has when multiplied left to right.
+def product_names(all_factors):
+	names = []
+	for f in all_factors:
+		names += [n for n in f.names if not n in names]
+	return names
+
+# the number of values of each variable of a (dense or sparse) factor.
+def shape_of(factor):
+	return factor.shape if is_sparse(factor) else factor.array.shape
+
+# the number of entries in the product of these factors.
+def product_size(all_factors):
+	cardinalities = {}
+	for f in all_factors:
+		cardinalities.update(zip(f.names,shape_of(f)))
+	return int(np.prod(list(cardinalities.values())))
+
+# the same factor with its variables in the given order.
+def reorder(factor,names):
+	if(list(factor.names)==list(names)):
+		return factor
+	permutation = [list(factor.names).index(n) for n in names]
+	if(is_sparse(factor)):
+		return factors_sparse.from_coords(names,[factor.shape[p] for p in permutation],factor.coords[:,permutation],factor.values)
+	return from_array(names,np.transpose(factor.array,permutation),factor.log)
+
+# PRODUCT AND MARGINALIZE TOGETHER
+# Same as marginalize(multiple_factor_product(all_factors),axis), but the full product is never made.
+# For ordinary dense factors it is one np.einsum call, with einsum choosing the order to multiply in (optimize="greedy")
+# and summing each variable out as soon as nothing else needs it. Log space or sparse factors (or more than 52 variables,
+# the most einsum can label) instead multiply only the factors with each variable in them and sum it out, one variable at a time.
+# Like marginalize, summing out everything gives a single number.
+def contract(all_factors,axis,log=None):
+	log = use_log(log,*all_factors)
+	names = product_names(all_factors)
+	kept_names = [n for n in names if not n in axis]
+	if(not log and not any([is_sparse(f) for f in all_factors]) and len(names)<=52):
+		labels = dict(zip(names,range(len(names))))
+		arguments = []
+		for f in all_factors:
+			arguments += [to_linear(f).array,[labels[n] for n in f.names]]
+		array = np.einsum(*arguments,[labels[n] for n in kept_names],optimize="greedy" if len(all_factors)>2 else False)
+		if(len(kept_names)==0):
+			return np.float64(array)
+		return from_array(kept_names,array)
+	remaining = list(all_factors)
+	# parts of the product which get summed down to a single number just scale everything else.
+	scale = 0.0 if log else 1.0
+	for var in [n for n in names if n in axis]:
+		with_var = [f for f in remaining if var in f.names]
+		remaining = [f for f in remaining if not var in f.names]
+		summed = marginalize(multiple_factor_product(with_var,log),[var],log)
+		if(isinstance(summed,(int,float))):
+			scale = scale+summed if log else scale*summed
+		else:
+			remaining.append(summed)
+	if(len(remaining)==0):
+		return np.float64(scale)
+	if(scale!=(0.0 if log else 1.0)):
+		remaining.append(from_array([],np.array(scale),log))
+	return reorder(multiple_factor_product(remaining,log),kept_names)
 
 # simple code to sample variables from the factor.
 def sample(factor,number_of_samples):
+	if(is_sparse(factor)):
+		return factors_sparse.sample(factor,number_of_samples)
 	array = factor.array
-	indexes = factor.indexes
+	if(factor.log):
+		array = np.exp(array-np.max(array))
 	normalized_array = array/np.sum(array)
-	rows = np.random.choice(np.arange(indexes.shape[0]),number_of_samples,p=normalized_array.reshape(-1))
-	return indexes[rows]
+	rows = np.random.choice(np.arange(array.size),number_of_samples,p=normalized_array.reshape(-1))
+	# same as indexes[rows], but without having to build the whole index.
+	return np.stack(np.unravel_index(rows,array.shape),axis=1)
+
 
 
 
 
 
+# MAXIMUM LIKELIHOOD for a directed PGM from complete samples, shape (N, len(sample_variable_names)).
+# Each factor's first variable is the child, the rest are its parents. Every sample row is turned into the flat index of its
+# cell in each table (np.ravel_multi_index) and np.bincount counts how many samples land in each cell. The counts are then
+# conditioned on the parents. pseudo_counts are added to every cell first (a Dirichlet prior), either one number for all
+# the factors or a list with one number (or array the shape of the factor) per factor.
+# With chunk_size the samples are counted chunk_size rows at a time, so samples can be a np.memmap (or the name of a
+# .npy file, which is opened as one) much bigger than memory.
+def MLE_directed_bayes_net(all_factors,sample_variable_names,samples,pseudo_counts=0,chunk_size=None):
+	if(isinstance(samples,str)):
+		samples = np.load(samples,mmap_mode="r")
+	if(not isinstance(pseudo_counts,(list,tuple))):
+		pseudo_counts = [pseudo_counts]*len(all_factors)
+	shapes = [shape_of(f) for f in all_factors]
+	columns = [[sample_variable_names.index(name) for name in f.names] for f in all_factors]
+	counts = [np.zeros(int(np.prod(shape))) for shape in shapes]
+	if(chunk_size==None):
+		chunk_size = max(samples.shape[0],1)
+	for start in range(0,samples.shape[0],chunk_size):
+		chunk = np.asarray(samples[start:start+chunk_size])
+		for j in range(len(all_factors)):
+			cells = np.ravel_multi_index(tuple(chunk[:,columns[j]].T),shapes[j])
+			counts[j] += np.bincount(cells,minlength=counts[j].shape[0])
+	new_factors = []
+	for j,f in enumerate(all_factors):
+		count_factor = from_array(f.names,counts[j].reshape(shapes[j])+pseudo_counts[j])
+		new_factors.append(condition(count_factor,axis=f.names[1:],in_place=True))
+	return new_factors
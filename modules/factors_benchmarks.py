@@ -0,0 +1,167 @@
+import factors
+import factors_inference
+import factors_junction_tree
+import factors_learning
+import factors_sampling
+import numpy as np
+import time
+
+# Small timing scripts for the factor code. Each benchmark keeps a copy of the old (slow) version of the code
+# it is replacing, so the speedup can be measured and the results can be checked against each other.
+# Run with e.g: python factors_benchmarks.py
+
+# times a function, taking the best of a few repeats.
+def best_time(function,repeats=3):
+	times = []
+	for r in range(repeats):
+		start = time.perf_counter()
+		function()
+		times.append(time.perf_counter()-start)
+	return min(times)
+
+# makes a random factor over the given names, every variable is binary.
+def random_binary_factor(names):
+	f = factors.Factor(names,[2]*len(names))
+	f.set_all(np.random.rand(2**len(names)))
+	return f
+
+# The old factor product, which goes through every index of the new factor one at a time.
+def loop_product(factor1,factor2):
+	names1 = factor1.names
+	names2 = factor2.names
+	joint_names = [n for n in names1 if n in names2]
+	new_names = names1 + [n for n in names2 if not n in joint_names]
+	from_2_to_new_index = [new_names.index(n) for n in names2]
+	factor2_not_joint_index = [n for n in range(len(names2)) if not names2[n] in joint_names]
+	new_shapes = list(factor1.array.shape)+[factor2.array.shape[n] for n in factor2_not_joint_index]
+	new_factor = factors.Factor(new_names,new_shapes)
+	for i in new_factor.indexes:
+		f1_part = i[:len(names1)]
+		f2_part = i[from_2_to_new_index]
+		new_factor.set(i,factor1.get(f1_part)*factor2.get(f2_part))
+	return new_factor
+
+# Product of two factors which share half their variables. The number of variables in the result grows
+# with num_vars, so the loop version grows with 2**num_vars python iterations.
+def benchmark_product(all_num_vars=[4,6,8,10,12,14]):
+	print("{:<10}{:<14}{:<14}{:<10}".format("num vars","loop (s)","broadcast (s)","speedup"))
+	for num_vars in all_num_vars:
+		names = ["X"+str(i) for i in range(num_vars)]
+		overlap = num_vars//2
+		factor1 = random_binary_factor(names[:overlap+(num_vars-overlap)//2])
+		factor2 = random_binary_factor(names[overlap:][::-1]+names[:overlap//2])
+		loop_result = loop_product(factor1,factor2)
+		broadcast_result = factors.product(factor1,factor2)
+		assert loop_result.names==broadcast_result.names
+		assert np.allclose(loop_result.array,broadcast_result.array)
+		loop_time = best_time(lambda: loop_product(factor1,factor2),1)
+		broadcast_time = best_time(lambda: factors.product(factor1,factor2))
+		print("{:<10}{:<14.5f}{:<14.5f}{:<10.1f}".format(len(broadcast_result.names),loop_time,broadcast_time,loop_time/broadcast_time))
+
+# a small directed network (A -> C <- B, C -> D, C -> E) with random tables.
+def random_network():
+	shapes = [(["A"],[2]),(["B"],[3]),(["C","A","B"],[2,2,3]),(["D","C"],[3,2]),(["E","C"],[2,2])]
+	all_factors = []
+	for names,pos_values in shapes:
+		f = factors.Factor(names,pos_values)
+		f.set_all(np.random.rand(np.prod(pos_values)))
+		all_factors.append(factors.condition(f,names[1:]))
+	return all_factors
+
+# Gibbs samples per second of the old one chain sampler and the multi chain sampler as the number of chains grows.
+def benchmark_gibbs(all_num_chains=[1,10,100,1000],num_sweeps=200):
+	all_factors = random_network()
+	old_time = best_time(lambda: factors_sampling.gibbs_sampling(all_factors,["D"],[1],num_sweeps),1)
+	print("{:<10}{:<20}".format("chains","samples per second"))
+	print("{:<10}{:<20.0f}".format("old",num_sweeps/old_time))
+	for num_chains in all_num_chains:
+		new_time = best_time(lambda: factors_sampling.multi_chain_gibbs_sampling(all_factors,["D"],[1],num_sweeps,num_chains),1)
+		print("{:<10}{:<20.0f}".format(num_chains,num_sweeps*num_chains/new_time))
+
+# checks every exact inference engine gives the same answer in log space as in linear space, both when given
+# log space factors and when LOG_SPACE is switched on for linear ones.
+def check_log_space():
+	all_factors = random_network()
+	unknown_vars = ["B","C","E"]
+	def answers(all_factors):
+		jt = factors_junction_tree.JunctionTree(all_factors).calibrate(["D"],[1])
+		names,batch = factors_inference.batch_sum_product_variable_elimination(all_factors,["D"],[[1]],unknown_vars)
+		results = [factors_inference.sum_product_variable_elimination(all_factors,["D"],[1],unknown_vars),
+				   factors_inference.full_joint_elimination(all_factors,["D"],[1],unknown_vars),
+				   factors.from_array(names,batch[0],factors.use_log(None,*all_factors)),
+				   factors_inference.compile_inference(all_factors,["D"],["A"]).run([1]),
+				   jt.marginal("A")]
+		return [factors.to_linear(r).array for r in results]
+	expected = answers(all_factors)[0]
+	log_factors = [factors.to_log(f) for f in all_factors]
+	for result in answers(log_factors):
+		assert np.allclose(result,expected)
+	factors.set_log_space(True)
+	try:
+		for result in answers(all_factors):
+			assert np.allclose(result,expected)
+	finally:
+		factors.set_log_space(False)
+	print("log space: all engines agree")
+
+# The old EM, which runs variable elimination once per row and adds the counts in one at a time.
+def loop_EM(prior_factors,data_variable_names,data,iterations):
+	old_factors = prior_factors
+	for iteration in range(iterations):
+		new_factors = [f.copy_zeros() for f in prior_factors]
+		for x in data:
+			known_names = [data_variable_names[v] for v in range(len(data_variable_names)) if x[v]!=-1]
+			known_evidence = x[x!=-1]
+			if(len(known_names)<len(data_variable_names)):
+				infered_factor = factors_inference.sum_product_variable_elimination(old_factors,known_names,known_evidence,[])
+				for unknown_vector in infered_factor.indexes:
+					full_evidence = x.copy()
+					full_evidence[[data_variable_names.index(v) for v in infered_factor.names]] = unknown_vector
+					probability = infered_factor.get(unknown_vector)
+					for j in range(len(old_factors)):
+						index = full_evidence[[data_variable_names.index(name) for name in old_factors[j].names]]
+						new_factors[j].set(index,new_factors[j].get(index)+probability)
+			else:
+				for j in range(len(old_factors)):
+					index = known_evidence[[data_variable_names.index(name) for name in old_factors[j].names]]
+					new_factors[j].set(index,new_factors[j].get(index)+1)
+		old_factors = [factors.condition(f,axis=f.names[1:]) for f in new_factors]
+	return old_factors
+
+# checks the batched EM against the old one when the prior gives some complete rows probability 0 (P(A=1)=0 here).
+# Those rows are still counted, so P(A) must come out finite and every table the same. Parent values which none of
+# the rows have are nan in both (0/0 when conditioning), so nan is compared as equal.
+def check_em_complete_rows():
+	rng = np.random.default_rng(0)
+	names,data = factors_sampling.batch_joint_sample_top_down(random_network(),300,rng)
+	data[:50,names.index("A")] = -1
+	prior = random_network()
+	prior[0].array = np.array([1.0,0.0])
+	expected = loop_EM(prior,names,data,3)
+	result = factors_inference.learn_directed_PGM_EM(prior,names,data,3,callback=lambda iteration,log_likelihood: None)
+	assert np.all(np.isfinite(result[0].array))
+	for e,r in zip(expected,result):
+		assert np.allclose(e.array,r.array,equal_nan=True)
+	print("EM: zero probability complete rows counted as before")
+
+# checks streaming complete batches through an OnlineLearner ends with the same tables as MLE_directed_bayes_net
+# on all the rows at once, starting from a uniform prior. Both add a pseudo count of 1, so parent values the data never
+# has come out uniform in both rather than nan in one.
+def check_online_learner(num_batches=10,batch_size=500):
+	rng = np.random.default_rng(0)
+	names,data = factors_sampling.batch_joint_sample_top_down(random_network(),num_batches*batch_size,rng)
+	prior = [factors.from_array(f.names,np.ones(f.array.shape)/f.array.shape[0]) for f in random_network()]
+	learner = factors_learning.OnlineLearner(prior,names,pseudo_counts=1)
+	for start in range(0,data.shape[0],batch_size):
+		learner.update(data[start:start+batch_size])
+	expected = factors.MLE_directed_bayes_net(prior,names,data,pseudo_counts=1)
+	for e,r in zip(expected,learner.factors):
+		assert np.allclose(e.array,r.array)
+	print("online learner: same tables as MLE on the whole data")
+
+if __name__=="__main__":
+	check_log_space()
+	check_em_complete_rows()
+	check_online_learner()
+	benchmark_product()
+	benchmark_gibbs()
@@ -0,0 +1,64 @@
+import factors
+import factors_sparse
+import numpy as np
+
+# DECISION NETWORKS
+# A decision network is a PGM (the chance factors) with decision variables, which are chosen rather than random,
+# and a utility factor giving how good each outcome is. The expected utility of a choice d given evidence e is
+#	EU(d) = sum over x of P(x|e,d)U(x) = (sum over x of P(x,e|d)U(x)) / P(e|d)
+# Rather than fixing the decision to one option at a time and running variable elimination once per option, the decision
+# variables are just never summed out (no factor is a distribution over them, they only show up as parents), so one
+# elimination gives the answer for every option, and every combination of options when there are several decision variables.
+# The top and the bottom of the fraction come from the same elimination too: the utility factor is stacked with a
+# factor of ones along a new variable (UTILITY_AXIS), and that variable is kept as well. Value 0 of it gives P(e|d) and
+# value 1 gives the expected utility part.
+# The value of perfect information (VPI) of some chance variables O is how much better the best decision gets on average
+# when O is seen before deciding: sum over o of P(o|e) max_d EU(d|e,o), minus max_d EU(d|e). Keeping O in the same elimination
+# gives the tables for every value of o at once, and summing them over o gives back the tables without seeing O,
+# so nothing is solved more than once. O are seen before the decision, so they can't depend on it.
+
+UTILITY_AXIS = "__utility__"
+
+# the utility factor and a factor of ones over the same variables, stacked along UTILITY_AXIS (first).
+def utility_stack(utility_factor):
+	array = factors.to_linear(utility_factor).array
+	return factors.from_array([UTILITY_AXIS]+list(utility_factor.names),np.stack([np.ones(array.shape),array]))
+
+# eliminates everything except the decision and kept variables. Returns the probability of the evidence P(e,kept|d)
+# and the unnormalized expected utility, both arrays with one axis for each decision variable and then each kept variable.
+def expected_utility_tables(chance_factors,utility_factor,decision_vars,kept_vars=[],known_vars=[],evidence=[]):
+	all_factors = []
+	for f in list(chance_factors)+[utility_stack(utility_factor)]:
+		dropped = factors.drop_variables(f,known_vars,evidence)
+		if(dropped!=None):
+			all_factors.append(dropped)
+	kept_names = [UTILITY_AXIS]+list(decision_vars)+list(kept_vars)
+	summed_out = [n for n in factors.product_names(all_factors) if not n in kept_names]
+	tables = factors.reorder(factors_sparse.to_dense(factors.contract(all_factors,summed_out,log=False)),kept_names).array # contract gives a SparseFactor if any factor is sparse.
+	return tables[0],tables[1]
+
+# the expected utility of every option, a factor over the decision variables.
+def expected_utilities(chance_factors,utility_factor,decision_vars,known_vars=[],evidence=[]):
+	probability,utility = expected_utility_tables(chance_factors,utility_factor,decision_vars,[],known_vars,evidence)
+	return factors.from_array(list(decision_vars),utility/probability)
+
+# the option (one value per decision variable) with the highest expected utility, and that utility.
+def best_decision(chance_factors,utility_factor,decision_vars,known_vars=[],evidence=[]):
+	utilities = expected_utilities(chance_factors,utility_factor,decision_vars,known_vars,evidence).array
+	best = np.unravel_index(np.argmax(utilities),utilities.shape)
+	return [int(b) for b in best],utilities[best]
+
+# the value of perfect information of observed_vars (seen together) given the evidence.
+def value_of_perfect_information(chance_factors,utility_factor,decision_vars,observed_vars,known_vars=[],evidence=[]):
+	probability,utility = expected_utility_tables(chance_factors,utility_factor,decision_vars,observed_vars,known_vars,evidence)
+	decision_axes = tuple(range(len(decision_vars)))
+	observed_axes = tuple(range(len(decision_vars),probability.ndim))
+	# without seeing O: add the tables up over its values.
+	best_without = np.max(np.sum(utility,axis=observed_axes)/np.sum(probability,axis=observed_axes))
+	# seeing O: the best option for each value of O, weighted by how likely that value is.
+	# P(o|e) doesn't depend on the decision, so it is read off the first option.
+	with np.errstate(divide="ignore",invalid="ignore"):
+		best_with = np.max(np.where(probability>0,utility/probability,-np.inf),axis=decision_axes)
+	first_option = probability[(0,)*len(decision_vars)]
+	p_observed = first_option/np.sum(first_option)
+	return np.sum(np.where(p_observed>0,p_observed*best_with,0))-best_without
@@ -1,34 +1,105 @@
 import factors
+import factors_ordering
+import factors_sparse
+import multiprocessing
 import numpy as np
+from collections import OrderedDict
+from multiprocessing import shared_memory
 
-def get_log_likelihood(all_factors,known_vars,evidence):
+# In log space (see factors.LOG_SPACE) the marginalizing is done with logsumexp and the values are added as they are.
+def get_log_likelihood(all_factors,known_vars,evidence,log=None):
+	log = factors.use_log(log,*all_factors)
 	prob = 0
 	for f in all_factors:
 		f_known_values = [evidence[known_vars.index(name)] for name in f.names if name in known_vars]
 		f_unknown_vars = [name for name in f.names if not name in known_vars]
 		if(len(f_unknown_vars)>0):
-			f_marg = factors.marginalize(f,f_unknown_vars)
+			f_marg = factors.marginalize(f,f_unknown_vars,log=log)
 			if(not isinstance(f_marg,(int,float))):
-				prob+=np.log(f_marg.get(f_known_values))
+				prob+=f_marg.get(f_known_values) if f_marg.log else np.log(f_marg.get(f_known_values))
 		else:
-			prob+=np.log(f.get(f_known_values))
+			prob+=f.get(f_known_values) if f.log else np.log(f.get(f_known_values))
 	return prob
 
+# get_log_likelihood for a whole dataset at once. data is (N, len(data_variable_names)) with -1 for missing values,
+# and the answer is the log likelihood of every row. Rows are grouped by which variables are missing. For each group
+# each factor is marginalized over its missing variables (only once for each set of missing variables, they are kept
+# in a dict), then the values of all the rows in the group are gathered from the table with np.ravel_multi_index.
+def dataset_log_likelihood(all_factors,data_variable_names,data,log=None):
+	log = factors.use_log(log,*all_factors)
+	data = np.asarray(data)
+	row_log_likelihoods = np.zeros(data.shape[0])
+	patterns,pattern_of_row = np.unique(data!=-1,axis=0,return_inverse=True)
+	pattern_of_row = pattern_of_row.reshape(-1)
+	marginalized = {}
+	for p in range(patterns.shape[0]):
+		in_group = pattern_of_row==p
+		group_rows = data[in_group]
+		known_vars = [data_variable_names[v] for v in np.nonzero(patterns[p])[0]]
+		for j,f in enumerate(all_factors):
+			f_unknown_vars = [name for name in f.names if not name in known_vars]
+			if(len(f_unknown_vars)==len(f.names)):
+				# everything is summed out, which gives a number and adds nothing (as in get_log_likelihood).
+				continue
+			key = (j,tuple(f_unknown_vars))
+			if(not key in marginalized):
+				f_marg = f if len(f_unknown_vars)==0 else factors.marginalize(f,f_unknown_vars,log=log)
+				marginalized[key] = factors.to_log(f_marg)
+			table = marginalized[key]
+			columns = [group_rows[:,data_variable_names.index(name)] for name in table.names]
+			row_log_likelihoods[in_group] += table.array.reshape(-1)[np.ravel_multi_index(columns,table.array.shape)]
+	return row_log_likelihoods
+
 # SUM PRODUCT
 # This runs the sum product algorithm for variable elimination. 
 # Every name in known_vars has a piece of evidence associated with it.
 # Every variable in unknown_vars is marginalized. Returns a joint distribution over what is left.
-# The order of unknown_vars is the order in which marginalization happens.
+# By default the order of unknown_vars is the order in which marginalization happens.
+# order can also be the name of one of the greedy heuristics in factors_ordering (e.g "min_fill"),
+# or "auto" which tries all of them and uses the one with the smallest largest table.
+# If an InferenceCache is given, answers and the factors made by each elimination step are kept in it and reused.
+# In log space (log=True, or see factors.LOG_SPACE) the answer is a log space factor.
 
-def sum_product_variable_elimination(all_factors,known_vars,evidence,unknown_vars):
+def sum_product_variable_elimination(all_factors,known_vars,evidence,unknown_vars,order=None,cache=None,log=None):
+	log = factors.use_log(log,*all_factors)
+	if(cache!=None):
+		evidence = [int(e) for e in evidence]
+		query_key = ("query",[factors.fingerprint(f) for f in all_factors],list(known_vars),evidence,list(unknown_vars),order,log)
+		cached = cache.get(query_key)
+		if(cached!=None):
+			return cached.copy()
 	# Step 1: condition by factor by setting each known variable to each piece of evidence
 	new_factors = []
 	for f in all_factors:
 		deleted_f = factors.drop_variables(f,known_vars,evidence)
 		if(deleted_f!=None):
+			if(cache!=None and deleted_f is not f):
+				set_vars = [(n,evidence[known_vars.index(n)]) for n in f.names if n in known_vars]
+				factors.set_fingerprint(deleted_f,("drop",factors.fingerprint(f),set_vars))
 			new_factors.append(deleted_f)
 	
-	# Step 2: marginalize all unknown variables. This requires merging all factors with the same variable name.
+	# Step 2: marginalize all unknown variables.
+	new_factors = eliminate_variables(new_factors,ordered_unknown_vars(new_factors,unknown_vars,order),cache,log)
+				
+	# merge all remaining factors
+	final_combined_factor = factors.multiple_factor_product(new_factors,log)
+	final_normalized_factor = factors.condition(final_combined_factor,log=log)
+	if(cache!=None):
+		cache.put(query_key,final_normalized_factor.copy())
+	return final_normalized_factor
+
+# puts unknown_vars in the order asked for (see above).
+def ordered_unknown_vars(new_factors,unknown_vars,order):
+	if(order=="auto"):
+		return factors_ordering.best_elimination_order(new_factors,[],unknown_vars)[0]
+	elif(order!=None):
+		return factors_ordering.greedy_elimination_order(new_factors,[],unknown_vars,order)[0]
+	return unknown_vars
+
+# marginalizes the unknown variables one at a time. This requires merging all factors with the same variable name.
+# With a cache, each step is keyed by the variable and the fingerprints of the factors it combines, so queries which
+# start by eliminating the same things (with the same evidence on those factors) share the work.
+def eliminate_variables(new_factors,unknown_vars,cache=None,log=False):
 	for unknown_var in unknown_vars:
 		factors_to_combine = []
 		factors_to_exclude = []
@@ -40,62 +111,321 @@ def sum_product_variable_elimination(all_factors,known_vars,evidence,unknown_var
 		# left over factors are the ones without the unknown variable and the marginalized product
 		new_factors = factors_to_exclude
 		if(len(factors_to_combine)>0):
-			combined_factor = factors.multiple_factor_product(factors_to_combine)
-			combined_factor = factors.marginalize(combined_factor,[unknown_var])
+			if(cache!=None):
+				message_key = ("message",unknown_var,[factors.fingerprint(f) for f in factors_to_combine],log)
+				combined_factor = cache.get(message_key)
+				if(combined_factor==None):
+					combined_factor = factors.contract(factors_to_combine,[unknown_var],log)
+					if(not isinstance(combined_factor,(int,float))):
+						factors.set_fingerprint(combined_factor,message_key)
+					cache.put(message_key,combined_factor)
+			else:
+				# multiplies and sums out in one go, so the product of everything with the variable in it is never made.
+				combined_factor = factors.contract(factors_to_combine,[unknown_var],log)
 			# If the resulting table is a single number, then all variables were marginalized, which means total independence, so ignore.
 			if(not isinstance(combined_factor,(int,float))):
 				new_factors.append(combined_factor)
-				
-	# merge all remaining factors
-	final_combined_factor = factors.multiple_factor_product(new_factors)
-	final_normalized_factor = factors.condition(final_combined_factor)
-	return final_normalized_factor
+	return new_factors
+
+# INFERENCE CACHE
+# An LRU cache for sum_product_variable_elimination. Keys are built from the fingerprints of the factors (names, shape and
+# a hash of the values, see factors.fingerprint) plus the evidence and the variables asked about, and are hashed down to short strings.
+# Changing a factor with set or set_all gives it a new fingerprint, so old answers for it are never returned again
+# (they just drop off the end of the cache). Memory is bounded by max_bytes, counting the bytes of the arrays kept.
+# The messages made by each elimination step are cached too (see eliminate_variables).
+
+class InferenceCache:
+	def __init__(self,max_bytes=64*2**20):
+		self.max_bytes = max_bytes
+		self.entries = OrderedDict()
+		self.bytes = 0
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+
+	# returns the cached value, or None if it isn't there.
+	def get(self,key):
+		key = factors.hash_key(key)
+		if(key in self.entries):
+			self.entries.move_to_end(key)
+			self.hits += 1
+			return self.entries[key]
+		self.misses += 1
+		return None
+
+	def put(self,key,value):
+		key = factors.hash_key(key)
+		size = self.size_of(value)
+		if(size>self.max_bytes):
+			return
+		if(key in self.entries):
+			self.bytes -= self.size_of(self.entries.pop(key))
+		self.entries[key] = value
+		self.bytes += size
+		# throw away the least recently used entries until it fits.
+		while(self.bytes>self.max_bytes):
+			key,old_value = self.entries.popitem(last=False)
+			self.bytes -= self.size_of(old_value)
+			self.evictions += 1
+
+	def size_of(self,value):
+		if(factors.is_sparse(value)):
+			return value.coords.nbytes+value.values.nbytes
+		return value.array.nbytes if isinstance(value,factors.Factor) else 8
+
+	def clear(self):
+		self.entries = OrderedDict()
+		self.bytes = 0
+
+	def stats(self):
+		return {"hits":self.hits,"misses":self.misses,"evictions":self.evictions,"entries":len(self.entries),"bytes":self.bytes}
+
+# BATCHED SUM PRODUCT
+# The same as sum_product_variable_elimination, but evidence is a 2d array with one row of evidence per query,
+# shape (n_queries, len(known_vars)). Every factor with evidence in it gets sliced at all the rows at once, which
+# gives it an extra variable (BATCH_AXIS) with one value per query. That variable is never eliminated, so it just gets
+# carried through every product and marginalization, and all the queries are answered by the same numpy calls.
+# Returns the names of the variables left and an array of shape (n_queries, ...) with one normalized joint per query.
+
+BATCH_AXIS = "__evidence_batch__"
+
+# like factors.drop_variables, but with one row of evidence per query. The batch axis goes first.
+def batch_drop_variables(factor,known_vars,evidence):
+	names = factor.names
+	var_index = [a for a in range(len(names)) if names[a] in known_vars]
+	if(len(var_index)<1):
+		return factor
+	not_var_index = [b for b in range(len(names)) if not b in var_index]
+	# with the known axes moved to the front, indexing them with the evidence columns puts the batch axis first.
+	array = np.transpose(factors_sparse.to_dense(factor).array,var_index+not_var_index)
+	sliced_array = array[tuple([evidence[:,known_vars.index(names[a])] for a in var_index])]
+	return factors.from_array([BATCH_AXIS]+[names[n] for n in not_var_index],sliced_array,factor.log)
+
+def batch_sum_product_variable_elimination(all_factors,known_vars,evidence,unknown_vars,order=None,log=None):
+	log = factors.use_log(log,*all_factors)
+	evidence = np.asarray(evidence)
+	if(evidence.ndim<2):
+		if(len(known_vars)==0):
+			# one query with no evidence, the same as sum_product_variable_elimination(all_factors,[],[],...).
+			if(evidence.size>0):
+				raise Exception('got {} pieces of evidence but no known variables. Pass a (n_queries, 0) array for several queries'.format(evidence.size))
+			evidence = np.zeros((1,0),dtype=int)
+		else:
+			evidence = evidence.reshape(-1,len(known_vars))
+	new_factors = [batch_drop_variables(f,known_vars,evidence) for f in all_factors]
+	new_factors = eliminate_variables(new_factors,ordered_unknown_vars(new_factors,unknown_vars,order),None,log)
+	final_combined_factor = factors.multiple_factor_product(new_factors,log)
+	names = [n for n in final_combined_factor.names if n!=BATCH_AXIS]
+	if(BATCH_AXIS in final_combined_factor.names):
+		array = np.moveaxis(final_combined_factor.array,final_combined_factor.names.index(BATCH_AXIS),0)
+	else:
+		# none of the evidence touched what is left, so every query has the same answer.
+		array = np.broadcast_to(final_combined_factor.array,(evidence.shape[0],)+final_combined_factor.array.shape)
+	batch_factor = factors.from_array([BATCH_AXIS]+names,array,log)
+	return names,factors.condition(batch_factor,[BATCH_AXIS],log=log).array
 
 # Does variable elimination by constructing full factor
-def full_joint_elimination(all_factors,known_vars,evidence,unknown_vars):
-	full_joint_factor = factors.multiple_factor_product(all_factors)
+def full_joint_elimination(all_factors,known_vars,evidence,unknown_vars,log=None):
+	log = factors.use_log(log,*all_factors)
+	full_joint_factor = factors.multiple_factor_product(all_factors,log)
 	set_vars = factors.drop_variables(full_joint_factor,known_vars,evidence)
-	marginalized = factors.marginalize(set_vars,unknown_vars)
+	marginalized = factors.marginalize(set_vars,unknown_vars,log)
 	if(marginalized!=None):
-		normalized = factors.condition(marginalized)
+		normalized = factors.condition(marginalized,log=log)
 		return normalized
 	else:
-		normalized = factors.condition(set_vars)
+		normalized = factors.condition(set_vars,log=log)
 		return normalized
 
+# COMPILED INFERENCE
+# When the same network is queried again and again with only the evidence values changing, most of the work in
+# sum_product_variable_elimination (finding scopes, choosing what to multiply, making new factors) is the same every time.
+# An InferencePlan does that work once. Every variable left after dropping the evidence gets an einsum label and
+# np.einsum_path picks the order to multiply things in. Each step of that path is stored as a small einsum
+# (which operands, their labels, the labels to keep) along with an array to write its answer into.
+# Running the plan then just slices each factor array at the evidence and runs the steps.
+# The plan reads f.array when it runs, so changes to the factors are picked up. np.einsum only has 52 labels,
+# so there can be at most 52 variables which aren't evidence.
+# Sparse factors are made dense each time the plan runs, as einsum only takes arrays.
+# einsum multiplies, so slices of log space factors are turned back into probabilities first (scaled so the biggest is 1,
+# which normalizing takes away again). The answer is in log space if the factors were (or LOG_SPACE is on).
+
+class InferencePlan:
+	def __init__(self,all_factors,known_vars,query_vars):
+		self.all_factors = all_factors
+		self.known_vars = list(known_vars)
+		self.query_vars = list(query_vars)
+		self.log = factors.use_log(None,*all_factors)
+		cardinalities = {}
+		for f in all_factors:
+			cardinalities.update(zip(f.names,factors.shape_of(f)))
+		free_vars = [n for n in cardinalities if not n in self.known_vars]
+		if(len(free_vars)>52):
+			raise Exception('a plan can have at most 52 variables which are not evidence, this one has {}'.format(len(free_vars)))
+		labels = dict(zip(free_vars,range(len(free_vars))))
+		label_sizes = [cardinalities[n] for n in free_vars]
+		# for each factor, the slice to take (filled in with evidence when run) and which piece of evidence goes on which axis.
+		self.slices = []
+		self.evidence_positions = []
+		sublists = []
+		for f in all_factors:
+			self.slices.append([slice(None)]*len(f.names))
+			self.evidence_positions.append([(a,self.known_vars.index(n)) for a,n in enumerate(f.names) if n in self.known_vars])
+			sublists.append([labels[n] for n in f.names if not n in self.known_vars])
+		output_sublist = [labels[n] for n in self.query_vars]
+		einsum_arguments = []
+		for sublist in sublists:
+			einsum_arguments += [np.empty([label_sizes[l] for l in sublist]),sublist]
+		path = np.einsum_path(*(einsum_arguments+[output_sublist]),optimize="greedy")[0]
+		# turn the path into steps. Each step takes operands out of the list and puts the result on the end.
+		# the result keeps the labels still needed by the operands left over or the output.
+		self.steps = []
+		for positions in path[1:]:
+			positions = sorted(positions,reverse=True)
+			step_sublists = [sublists.pop(p) for p in positions]
+			if(len(sublists)==0):
+				kept = output_sublist
+			else:
+				needed = set(output_sublist).union(*sublists)
+				kept = sorted(set().union(*step_sublists).intersection(needed))
+			buffer = np.empty([label_sizes[l] for l in kept])
+			self.steps.append((positions,step_sublists,kept,buffer))
+			sublists.append(kept)
+		self.out = self.steps[-1][3]
+
+	# returns the normalized joint over query_vars given the evidence (in the same order as known_vars).
+	def run(self,evidence):
+		operands = []
+		for f,slc,positions in zip(self.all_factors,self.slices,self.evidence_positions):
+			for axis,e in positions:
+				slc[axis] = evidence[e]
+			operand = factors_sparse.to_dense(f).array[tuple(slc)]
+			if(f.log):
+				largest = np.max(operand)
+				operand = np.exp(operand-largest) if np.isfinite(largest) else np.zeros(operand.shape)
+			operands.append(operand)
+		for positions,step_sublists,kept,buffer in self.steps:
+			arguments = []
+			for p,sublist in zip(positions,step_sublists):
+				arguments += [operands.pop(p),sublist]
+			np.einsum(*arguments,kept,out=buffer)
+			operands.append(buffer)
+		return factors.to_space(factors.from_array(self.query_vars,self.out/np.sum(self.out)),self.log)
+
+# makes a plan for querying the joint over query_vars. Every variable not known or queried is summed out.
+def compile_inference(all_factors,known_vars,query_vars):
+	return InferencePlan(all_factors,known_vars,query_vars)
+
 # Learns a directed model MLE parameters, using the EM algorithm.
-def learn_directed_PGM_EM(prior_factors,data_variable_names,data,iterations):
-	old_factors = prior_factors
-	for iteration in range(iterations):
-		log_likelihood = 0
-		new_factors = [f.copy_zeros() for f in prior_factors]
-		for x in data:
-			known_names = [data_variable_names[v] for v in range(len(data_variable_names)) if x[v]!=-1]
-			known_evidence = x[x!=-1]
-			if(len(known_names)<len(data_variable_names)):
-				# E step: Infer the distribution over unknowns
-				infered_factor = sum_product_variable_elimination(old_factors,known_names,known_evidence,[])
-				# go through every possible option
-				for unknown_vector in infered_factor.indexes:
-					# get the full evidence vector, filling in the missing values.
-					infered_factor_to_sample_index_transform = [data_variable_names.index(v) for v in infered_factor.names]
-					full_evidence = x.copy()
-					full_evidence[infered_factor_to_sample_index_transform]=unknown_vector
-					probability = infered_factor.get(unknown_vector)
-					# For each factor update the counts at the given index.
-					for j in range(len(old_factors)):
-						# have to first make sure the indexing is the same as the order of variables can change. 
-						factor_to_sample_index_transform = [data_variable_names.index(name) for name in old_factors[j].names]
-						rearanged_index = full_evidence[factor_to_sample_index_transform]
-						old_value = new_factors[j].get(rearanged_index)
-						new_factors[j].set(rearanged_index,old_value+probability)
+# EM for a directed PGM. Rows with the same values (and the same missing values) give the same expected counts,
+# so the data is first cut down to its unique rows and how many times each one appears.
+# The unique rows are then grouped by which variables are missing, and each group is done with one batched
+# variable elimination (see batch_sum_product_variable_elimination) rather than one elimination per row.
+# With processes set, the E step is a map-reduce: the unique rows are split into shards, each shard's expected counts
+# are worked out in a process pool, and the counts are added up before the M step. The rows are put in shared memory
+# once, when the pool starts, so only the current factors are sent to the workers each iteration.
+# iterations is the most iterations to run. With a tolerance it stops early once the log likelihood changes by less than that.
+# The log likelihood of each iteration is given to callback(iteration,log_likelihood), which prints it by default.
+def learn_directed_PGM_EM(prior_factors,data_variable_names,data,iterations,tolerance=None,callback=None,processes=None,shards=None):
+	if(callback==None):
+		callback = print_log_likelihood
+	rows,counts = np.unique(np.asarray(data),axis=0,return_counts=True)
+	table = np.concatenate([rows,counts[:,None]],axis=1)
+	memory = None
+	pool = None
+	try:
+		if(processes!=None and processes>1):
+			memory = shared_memory.SharedMemory(create=True,size=max(table.nbytes,1))
+			np.ndarray(table.shape,dtype=table.dtype,buffer=memory.buf)[:] = table
+			pool = multiprocessing.Pool(processes,initializer=attach_shared_rows,initargs=(memory.name,table.shape,table.dtype))
+			bounds = np.linspace(0,table.shape[0],(shards or processes)+1).astype(int)
+		old_factors = prior_factors
+		old_log_likelihood = None
+		for iteration in range(iterations):
+			if(pool==None):
+				new_factors,log_likelihood = e_step(old_factors,data_variable_names,table)
 			else:
-				for j in range(len(old_factors)):
-					factor_to_sample_index_transform = [data_variable_names.index(name) for name in old_factors[j].names]
-					rearanged_index = known_evidence[factor_to_sample_index_transform]
-					old_value = new_factors[j].get(rearanged_index)
-					new_factors[j].set(rearanged_index,old_value+1)
-			log_likelihood += get_log_likelihood(old_factors,known_names,known_evidence)
-		print("log likelihood",log_likelihood)
-		old_factors = [factors.condition(f,axis=f.names[1:]) for f in new_factors]
+				results = pool.map(e_step_shard,[(old_factors,data_variable_names,bounds[s],bounds[s+1]) for s in range(len(bounds)-1)])
+				new_factors = results[0][0]
+				for shard_factors,shard_log_likelihood in results[1:]:
+					for f,shard_f in zip(new_factors,shard_factors):
+						f.array += shard_f.array
+				log_likelihood = sum([r[1] for r in results])
+			callback(iteration,log_likelihood)
+			old_factors = [factors.condition(f,axis=f.names[1:],in_place=True) for f in new_factors] # the count factors are new each iteration, so reuse them.
+			if(tolerance!=None and old_log_likelihood!=None and abs(log_likelihood-old_log_likelihood)<tolerance):
+				break
+			old_log_likelihood = log_likelihood
+	finally:
+		if(pool!=None):
+			pool.close()
+			pool.join()
+		if(memory!=None):
+			memory.close()
+			memory.unlink()
 	return old_factors
+
+def print_log_likelihood(iteration,log_likelihood):
+	print("log likelihood",log_likelihood)
+
+# the E step over a table of unique rows, the last column being how many times each row appears.
+# returns the expected count factors and the log likelihood of the rows under old_factors.
+def e_step(old_factors,data_variable_names,table):
+	rows = table[:,:-1]
+	counts = table[:,-1]
+	new_factors = [factors.Factor(f.names,list(factors.shape_of(f))) for f in old_factors] # dense counts, even for sparse factors.
+	patterns,pattern_of_row = np.unique(rows!=-1,axis=0,return_inverse=True)
+	pattern_of_row = pattern_of_row.reshape(-1)
+	for p in range(patterns.shape[0]):
+		group_rows = rows[pattern_of_row==p]
+		group_counts = counts[pattern_of_row==p]
+		known_index = np.nonzero(patterns[p])[0]
+		known_names = [data_variable_names[v] for v in known_index]
+		if(len(known_names)==len(data_variable_names)):
+			# nothing to infer, the rows are counted as they are (even the ones the old factors give probability 0).
+			add_complete_counts(new_factors,data_variable_names,group_rows,group_counts)
+			continue
+		# infer the distribution over the unknowns of every row in the group at once.
+		unknown_names,posterior = batch_sum_product_variable_elimination(old_factors,known_names,group_rows[:,known_index],[],log=False)
+		add_expected_counts(new_factors,known_names,group_rows[:,known_index],unknown_names,posterior,group_counts)
+	log_likelihood = np.sum(counts*dataset_log_likelihood(old_factors,data_variable_names,rows))
+	return new_factors,log_likelihood
+
+# the rows in shared memory, set up once in each worker process of the pool.
+SHARED_ROWS = {}
+
+def attach_shared_rows(name,shape,dtype):
+	SHARED_ROWS["memory"] = shared_memory.SharedMemory(name=name)
+	SHARED_ROWS["table"] = np.ndarray(shape,dtype=dtype,buffer=SHARED_ROWS["memory"].buf)
+
+def e_step_shard(arguments):
+	old_factors,data_variable_names,start,stop = arguments
+	return e_step(old_factors,data_variable_names,SHARED_ROWS["table"][start:stop])
+
+# adds complete rows (no -1) into the count factors, weights[i] times for row i, in the same way as MLE_directed_bayes_net.
+def add_complete_counts(count_factors,data_variable_names,rows,weights):
+	for f in count_factors:
+		shape = f.array.shape
+		cells = np.ravel_multi_index(tuple(rows[:,[data_variable_names.index(name) for name in f.names]].T),shape)
+		f.array += np.bincount(cells,weights=weights,minlength=f.array.size).reshape(shape)
+
+# adds the expected counts of a group of rows into the count factors.
+# evidence has one row per data row, posterior (n_rows, ...) is the distribution over unknown_names for each row,
+# and weights is how many times each row appears. For each factor the posterior is summed down to the unknowns in
+# the factor, then scatter-added (np.add.at) at the known values of each row, so rows with the same values add up.
+def add_expected_counts(count_factors,known_names,evidence,unknown_names,posterior,weights):
+	for f in count_factors:
+		known_axes = [a for a in range(len(f.names)) if f.names[a] in known_names]
+		unknown_axes = [a for a in range(len(f.names)) if not f.names[a] in known_names]
+		f_unknown_names = [f.names[a] for a in unknown_axes]
+		summed_axes = tuple([1+i for i in range(len(unknown_names)) if not unknown_names[i] in f_unknown_names])
+		f_posterior = np.sum(posterior,axis=summed_axes)
+		left = [n for n in unknown_names if n in f_unknown_names]
+		f_posterior = np.transpose(f_posterior,[0]+[1+left.index(n) for n in f_unknown_names])
+		f_posterior = f_posterior*np.reshape(weights,(-1,)+(1,)*len(unknown_axes))
+		if(len(known_axes)==0):
+			f.array += np.sum(f_posterior,axis=0)
+			continue
+		# with the known axes moved to the front, indexing them with the evidence columns lines up with f_posterior.
+		target = np.transpose(f.array,known_axes+unknown_axes)
+		np.add.at(target,tuple([evidence[:,known_names.index(f.names[a])] for a in known_axes]),f_posterior)
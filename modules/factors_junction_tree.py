@@ -0,0 +1,173 @@
+import factors
+import factors_ordering
+import factors_sparse
+import numpy as np
+
+# JUNCTION TREE
+# Variable elimination starts again from scratch for every query, so asking for the marginal of every variable
+# repeats nearly all of the work once per variable. A junction tree (clique tree) does the work once.
+# 1. Triangulate: eliminate every variable (on paper, using factors_ordering). Each elimination gives a clique, the variable
+#	 and its neighbours at the time. Cliques inside a bigger clique are thrown away.
+# 2. Connect the cliques into a tree, using the biggest overlaps (separators) first. This keeps the running intersection
+#	 property: a variable in two cliques is in every clique on the path between them.
+# 3. Give every factor to one clique which has all of its variables. The clique potential is the product of its factors.
+# 4. Calibrate: pass a message along every edge in both directions. The message from i to j is the product of the potential
+#	 of i and all the messages into i (except the one from j), summed down to the separator.
+# After that the belief of a clique (potential times all incoming messages) is the joint over its variables,
+# so the marginal of any variable is looked up from a clique which has it.
+# Sparse factors are made dense first, as the clique potentials are full tables anyway.
+# Evidence is added by multiplying an indicator factor into one clique per known variable, so the tree never changes shape.
+# When only the evidence changes, only the messages coming out of the side of the tree with the changed cliques are redone.
+
+class JunctionTree:
+	def __init__(self,all_factors,heuristic="min_fill"):
+		all_factors = [factors_sparse.to_dense(f) for f in all_factors]
+		cardinalities,neighbours = factors_ordering.interaction_graph(all_factors)
+		self.cardinalities = cardinalities
+		if(heuristic=="auto"):
+			order = factors_ordering.best_elimination_order(all_factors,[],list(cardinalities))[0]
+		else:
+			order = factors_ordering.greedy_elimination_order(all_factors,[],list(cardinalities),heuristic)[0]
+		# Step 1: cliques from eliminating everything.
+		cliques = []
+		for var in order:
+			clique = set(neighbours[var])|{var}
+			factors_ordering.eliminate_from_graph(var,cardinalities,neighbours)
+			if(not any([clique<=c for c in cliques])):
+				cliques = [c for c in cliques if not c<clique]+[clique]
+		self.cliques = [[v for v in order if v in c] for c in cliques]
+		# Step 2: maximum spanning tree over separator sizes (Kruskal). Empty separators are allowed so it is always one tree.
+		candidate_edges = [(len(cliques[i]&cliques[j]),i,j) for i in range(len(cliques)) for j in range(i+1,len(cliques))]
+		candidate_edges.sort(key=lambda e: -e[0])
+		group = list(range(len(cliques)))
+		def find(i):
+			while(group[i]!=i):
+				i = group[i]
+			return i
+		self.neighbours = [[] for c in cliques]
+		self.separators = {}
+		for size,i,j in candidate_edges:
+			if(find(i)!=find(j)):
+				group[find(i)] = find(j)
+				self.neighbours[i].append(j)
+				self.neighbours[j].append(i)
+				self.separators[(i,j)] = self.separators[(j,i)] = [v for v in self.cliques[i] if v in cliques[j]]
+		# Step 3: the clique potentials. Each starts as all ones so it covers every variable of the clique.
+		self.potentials = []
+		for clique in self.cliques:
+			ones = factors.from_array(clique,np.ones([cardinalities[v] for v in clique]))
+			self.potentials.append(ones)
+		for f in all_factors:
+			c = [i for i in range(len(self.cliques)) if set(f.names)<=set(self.cliques[i])][0]
+			self.potentials[c] = factors.product(self.potentials[c],f)
+		self.potentials = [factors.reorder(p,clique) for clique,p in zip(self.cliques,self.potentials)]
+		self.variable_clique = dict([(v,[i for i in range(len(self.cliques)) if v in self.cliques[i]][0]) for v in cardinalities])
+		# message schedule: edges pointing at clique 0 from the leaves in, then the same edges the other way round.
+		upward = []
+		visited = {0}
+		stack = [0]
+		while(len(stack)>0):
+			i = stack.pop()
+			for j in self.neighbours[i]:
+				if(not j in visited):
+					visited.add(j)
+					upward.append((j,i))
+					stack.append(j)
+		upward.reverse()
+		self.schedule = upward+[(j,i) for i,j in reversed(upward)]
+		# the cliques on the sending side of each edge. A message only needs redoing if one of these changed.
+		self.upstream = {}
+		for i,j in upward:
+			self.upstream[(i,j)] = self.subtree(i,j)
+			self.upstream[(j,i)] = set(range(len(self.cliques)))-self.upstream[(i,j)]
+		self.evidence = None
+		self.messages = {}
+		self.beliefs = [None]*len(self.cliques)
+		self.marginals = {}
+
+	# all cliques reached from i without going through j.
+	def subtree(self,i,j):
+		reached = {i}
+		stack = [i]
+		while(len(stack)>0):
+			k = stack.pop()
+			for n in self.neighbours[k]:
+				if(n!=j and not n in reached):
+					reached.add(n)
+					stack.append(n)
+		return reached
+
+	# the potential of clique i times an indicator for each known variable given to it.
+	def evidence_potential(self,i):
+		potential = self.potentials[i]
+		for var,value in self.evidence.items():
+			if(self.variable_clique[var]==i):
+				indicator = factors.Factor([var],[self.cardinalities[var]])
+				indicator.set([value],1)
+				potential = factors.product(potential,indicator)
+		return potential
+
+	# product of the (evidence) potential of i and the messages into i, leaving out the one from skip.
+	def clique_product(self,i,skip=None):
+		incoming = [self.messages[(k,i)] for k in self.neighbours[i] if k!=skip and self.messages[(k,i)]!=None]
+		return factors.multiple_factor_product([self.evidence_potentials[i]]+incoming)
+
+	# runs message passing for the given evidence. Only the messages and beliefs which depend on changed evidence are redone.
+	def calibrate(self,known_vars=[],evidence=[]):
+		new_evidence = dict(zip(known_vars,[int(e) for e in evidence]))
+		if(self.evidence==None):
+			changed = set(range(len(self.cliques)))
+		else:
+			changed_vars = [v for v in set(new_evidence)|set(self.evidence) if new_evidence.get(v)!=self.evidence.get(v)]
+			changed = set([self.variable_clique[v] for v in changed_vars])
+		self.evidence = new_evidence
+		if(len(changed)==0):
+			return self
+		if(len(changed)==len(self.cliques)):
+			self.evidence_potentials = [self.evidence_potential(i) for i in range(len(self.cliques))]
+		else:
+			for i in changed:
+				self.evidence_potentials[i] = self.evidence_potential(i)
+		redone = set(changed)
+		for i,j in self.schedule:
+			if((i,j) in self.messages and len(self.upstream[(i,j)]&changed)==0):
+				continue
+			separator = self.separators[(i,j)]
+			summed_out = [v for v in self.cliques[i] if not v in separator]
+			message = self.clique_product(i,skip=j)
+			if(len(separator)==0):
+				# nothing shared, the message is just a number, which normalization removes anyway.
+				message = None
+			else:
+				if(len(summed_out)>0):
+					message = factors.marginalize(message,summed_out)
+				# normalizing the messages stops long chains of products from underflowing.
+				message = factors.condition(message)
+			self.messages[(i,j)] = message
+			redone.add(j)
+		for i in redone:
+			belief = self.clique_product(i)
+			self.beliefs[i] = factors.reorder(belief,self.cliques[i])
+			for var in self.cliques[i]:
+				if(self.variable_clique[var]==i):
+					self.marginals[var] = self.belief_marginal(i,[var])
+		return self
+
+	# the normalized belief of clique i summed down to the given names.
+	def belief_marginal(self,i,names):
+		summed_out = [v for v in self.cliques[i] if not v in names]
+		belief = self.beliefs[i]
+		if(len(summed_out)>0):
+			belief = factors.marginalize(belief,summed_out)
+		return factors.condition(belief)
+
+	# the posterior marginal of a single variable (a lookup after calibration).
+	def marginal(self,var):
+		return self.marginals[var]
+
+	# the posterior joint over variables which are all in one clique.
+	def joint_marginal(self,names):
+		for i in range(len(self.cliques)):
+			if(set(names)<=set(self.cliques[i])):
+				return self.belief_marginal(i,names)
+		raise Exception('no clique has all of {}'.format(names))
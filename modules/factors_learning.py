@@ -0,0 +1,87 @@
+import factors
+import factors_inference
+import factors_sparse
+import numpy as np
+
+# ONLINE LEARNING
+# MLE_directed_bayes_net and learn_directed_PGM_EM both start again from the whole dataset. When new rows keep arriving
+# an OnlineLearner keeps a count table (the sufficient statistics) for each factor, next to the factor itself, and
+# adds each mini-batch of rows into the counts as it comes in:
+#	complete rows add 1 to the cell they land in.
+#	partial rows (-1 for missing) add their expected counts under the current factors (the E step of EM, see
+#	factors_inference.e_step), so the factors are updated once per batch (online or incremental EM).
+# With decay set, the counts are updated stepwise instead: counts = (1-rate)*counts + rate*batch_counts, where
+# rate = (step+2)**-decay. decay should be between 0.5 and 1. Older batches then count for less, which helps EM
+# with partial rows forget the early guesses, and lets the factors follow data which changes over time.
+# Only the parent configurations (columns of the table, as the first variable is the child) which the batch
+# put counts into are renormalized. The work per batch depends on the batch size and the table sizes, never on how many
+# rows have been seen before.
+# snapshot() gives the state as plain lists and arrays (e.g for pickle or np.savez) and restore_online_learner brings it back.
+
+class OnlineLearner:
+	def __init__(self,prior_factors,data_variable_names,pseudo_counts=0,decay=None):
+		self.data_variable_names = list(data_variable_names)
+		self.factors = [factors.to_linear(factors_sparse.to_dense(f)).copy() for f in prior_factors]
+		if(not isinstance(pseudo_counts,(list,tuple))):
+			pseudo_counts = [pseudo_counts]*len(prior_factors)
+		self.counts = [np.zeros(f.array.shape)+p for f,p in zip(self.factors,pseudo_counts)]
+		self.decay = decay
+		self.steps = 0
+		self.log_likelihood = None
+
+	# adds a mini-batch of rows, shape (n, len(data_variable_names)). Returns the log likelihood of the batch
+	# under the factors from before the update.
+	def update(self,batch):
+		rows,row_counts = np.unique(np.asarray(batch),axis=0,return_counts=True)
+		complete = np.all(rows!=-1,axis=1)
+		# only the partial rows go through the E step, the complete ones are counted as they are.
+		if(np.all(complete)):
+			batch_factors = [f.copy_zeros() for f in self.factors]
+			self.log_likelihood = 0
+		else:
+			table = np.concatenate([rows,row_counts[:,None]],axis=1)[~complete]
+			batch_factors,self.log_likelihood = factors_inference.e_step(self.factors,self.data_variable_names,table)
+		factors_inference.add_complete_counts(batch_factors,self.data_variable_names,rows[complete],row_counts[complete])
+		self.log_likelihood += np.sum(row_counts[complete]*factors_inference.dataset_log_likelihood(self.factors,self.data_variable_names,rows[complete]))
+		if(self.decay!=None):
+			rate = (self.steps+2.0)**-self.decay
+		for j,batch_factor in enumerate(batch_factors):
+			batch_counts = batch_factor.array
+			if(self.decay==None):
+				self.counts[j] += batch_counts
+			else:
+				self.counts[j] *= 1-rate
+				self.counts[j] += rate*batch_counts
+			self.renormalize(j,np.any(batch_counts.reshape(batch_counts.shape[0],-1)>0,axis=0))
+		self.steps += 1
+		return self.log_likelihood
+
+	# conditions the counts of factor j on its parents, only for the parent configurations in touched.
+	def renormalize(self,j,touched):
+		if(not np.any(touched)):
+			return
+		f = self.factors[j]
+		shape = f.array.shape
+		counts = self.counts[j].reshape(shape[0],-1)[:,touched]
+		cpd = f.array.reshape(shape[0],-1).copy()
+		with np.errstate(divide="ignore",invalid="ignore"):
+			cpd[:,touched] = counts/np.sum(counts,axis=0)
+		f.array = cpd.reshape(shape)
+
+	def snapshot(self):
+		return {"data_variable_names":list(self.data_variable_names),
+				"names":[list(f.names) for f in self.factors],
+				"factors":[f.array.copy() for f in self.factors],
+				"counts":[c.copy() for c in self.counts],
+				"decay":self.decay,
+				"steps":self.steps}
+
+def restore_online_learner(snapshot):
+	learner = OnlineLearner.__new__(OnlineLearner)
+	learner.data_variable_names = list(snapshot["data_variable_names"])
+	learner.factors = [factors.from_array(list(names),np.array(array)) for names,array in zip(snapshot["names"],snapshot["factors"])]
+	learner.counts = [np.array(c,dtype=float) for c in snapshot["counts"]]
+	learner.decay = snapshot["decay"]
+	learner.steps = snapshot["steps"]
+	learner.log_likelihood = None
+	return learner
@@ -0,0 +1,85 @@
+import factors
+import numpy as np
+
+# Elimination orders for variable elimination.
+# The order variables are summed out in doesn't change the answer, but it changes how big the factors made along the way are.
+# Eliminating a variable multiplies every factor it is in, so the new table covers the variable and all its neighbours
+# in the interaction graph (two variables are neighbours if they share a factor). Afterwards the neighbours are all
+# in one factor together, so they become connected to each other. Those new edges are called fill edges.
+# Finding the best order is NP-hard, so the usual thing is to greedily pick the variable which looks cheapest at each step:
+#	min_degree: the variable with the fewest neighbours.
+#	min_fill: the variable which adds the fewest fill edges.
+#	min_weight: the variable whose new table is smallest (product of the number of values of it and its neighbours).
+
+HEURISTICS = ["min_fill","min_degree","min_weight"]
+
+# builds the interaction graph from the factor scopes. Known variables are left out, as they get dropped before elimination.
+# returns a dict of the number of values of each variable and a dict of the set of neighbours of each variable.
+def interaction_graph(all_factors,known_vars=[]):
+	cardinalities = {}
+	neighbours = {}
+	for f in all_factors:
+		names = [n for n in f.names if not n in known_vars]
+		shape = factors.shape_of(f)
+		for i,name in enumerate(f.names):
+			if(not name in known_vars):
+				cardinalities[name] = shape[i]
+				neighbours.setdefault(name,set()).update(names)
+	for name in neighbours:
+		neighbours[name].discard(name)
+	return cardinalities,neighbours
+
+# the score used to pick the next variable, lower is better.
+def heuristic_score(var,cardinalities,neighbours,heuristic):
+	if(heuristic=="min_degree"):
+		return len(neighbours[var])
+	elif(heuristic=="min_weight"):
+		return cardinalities[var]*np.prod([cardinalities[n] for n in neighbours[var]])
+	elif(heuristic=="min_fill"):
+		nbrs = list(neighbours[var])
+		return sum([1 for i in range(len(nbrs)) for j in range(i+1,len(nbrs)) if not nbrs[j] in neighbours[nbrs[i]]])
+	else:
+		raise Exception('unknown heuristic {}. Use one of {}'.format(heuristic,HEURISTICS))
+
+# removes a variable from the graph, connecting all its neighbours. Returns the size of the table made when eliminating it.
+def eliminate_from_graph(var,cardinalities,neighbours):
+	nbrs = neighbours.pop(var)
+	table_size = cardinalities[var]*int(np.prod([cardinalities[n] for n in nbrs]))
+	for n in nbrs:
+		neighbours[n].discard(var)
+		neighbours[n].update(nbrs-{n})
+	return table_size
+
+# the predicted cost of eliminating the variables in the given order.
+# returns the size of the largest table made and the total size of all tables made.
+def elimination_cost(all_factors,known_vars,order):
+	cardinalities,neighbours = interaction_graph(all_factors,known_vars)
+	table_sizes = [eliminate_from_graph(var,cardinalities,neighbours) for var in order if var in neighbours]
+	if(len(table_sizes)==0):
+		return 0,0
+	return max(table_sizes),sum(table_sizes)
+
+# greedily builds an order for the variables in vars_to_eliminate. Ties go to the variable listed first.
+# returns the order, the size of the largest table made and the total size of all tables made.
+def greedy_elimination_order(all_factors,known_vars,vars_to_eliminate,heuristic="min_fill"):
+	cardinalities,neighbours = interaction_graph(all_factors,known_vars)
+	remaining = [v for v in vars_to_eliminate if v in neighbours]
+	order = []
+	table_sizes = []
+	while(len(remaining)>0):
+		scores = [heuristic_score(v,cardinalities,neighbours,heuristic) for v in remaining]
+		var = remaining.pop(int(np.argmin(scores)))
+		table_sizes.append(eliminate_from_graph(var,cardinalities,neighbours))
+		order.append(var)
+	# variables which aren't in any factor don't cost anything, they go at the end.
+	order += [v for v in vars_to_eliminate if not v in order]
+	if(len(table_sizes)==0):
+		return order,0,0
+	return order,max(table_sizes),sum(table_sizes)
+
+# runs every heuristic and keeps the order with the smallest largest table (then the smallest total).
+# returns the order, the size of the largest table made and the total size of all tables made.
+def best_elimination_order(all_factors,known_vars,vars_to_eliminate,heuristics=HEURISTICS):
+	plans = [greedy_elimination_order(all_factors,known_vars,vars_to_eliminate,h) for h in heuristics]
+	best = min(range(len(plans)),key=lambda p: (plans[p][1],plans[p][2]))
+	return plans[best]
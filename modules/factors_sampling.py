@@ -1,4 +1,5 @@
 import factors
+import factors_sparse
 import numpy as np
 
 # Samples by setting the variables in order from top to bottom. Requires a directed factor graph. This is probably not going to work for an undirected graph.
@@ -25,10 +26,12 @@ def joint_sample_top_down(all_factors):
     return assigned_variable_names,variable_assignments
 
 # Likelihood weighted sampling. For normalized importance sampling to pgms. Similar to above but sets all observed variables and returns weight.
-def likelihood_weighting_top_down(all_factors,known_vars,evidence):
+# In log space (log=True, or see factors.LOG_SPACE) the weight returned is a log weight, so it can't underflow.
+def likelihood_weighting_top_down(all_factors,known_vars,evidence,log=None):
+    log = factors.use_log(log,*all_factors)
     assigned_variable_names = []
     variable_assignments = []
-    weight = 1
+    weight = 0 if log else 1
     remaining_factors = all_factors.copy()
     
     while(len(remaining_factors)>0):
@@ -38,11 +41,14 @@ def likelihood_weighting_top_down(all_factors,known_vars,evidence):
         for f in remaining_factors:
             if(len(f.names)==1 or np.prod([i in assigned_variable_names for i in f.names[1:]])==1):
                 var_dropped_factor = factors.drop_variables(f,assigned_variable_names,variable_assignments)
-                conditioned_factor = factors.condition(var_dropped_factor)
+                conditioned_factor = factors.condition(var_dropped_factor,log=log)
                 if(f.names[0] in known_vars):
                     evid = evidence[known_vars.index(f.names[0])]
                     new_variable_assignments.append(evid)
-                    weight *= conditioned_factor.get([evid])
+                    if(log):
+                        weight += conditioned_factor.get([evid])
+                    else:
+                        weight *= conditioned_factor.get([evid])
                 else:
                     sample = factors.sample(conditioned_factor,1)[0][0]
                     new_variable_assignments.append(sample)
@@ -63,8 +69,6 @@ def gibbs_step(all_variable_markov_blankets,fixed_variables,all_variable_names,c
         if(not var_name in fixed_variables):
             joint = all_variable_markov_blankets[all_variable_names.index(var_name)]
             index = all_variable_names.index(var_name)
-            other_var_names = list(all_variable_names[:index])+list(all_variable_names[(index+1):])
-            other_var_vals = list(current_state_values[:index])+list(current_state_values[(index+1):])
             slc = [slice(None)]*len(joint.names)
             for i in range(len(all_variable_names)):
                 if(all_variable_names[i] in joint.names):
@@ -72,15 +76,17 @@ def gibbs_step(all_variable_markov_blankets,fixed_variables,all_variable_names,c
             joint_index = joint.names.index(var_name)
             slc[joint_index]=slice(0,joint.array.shape[joint_index])
             array_slice = np.squeeze(joint.array[tuple(slc)])
+            if(joint.log):
+                array_slice = np.exp(array_slice-np.max(array_slice))
             norm_array_slice = array_slice/np.sum(array_slice)
-            cond_joint = factors.drop_variables(joint,other_var_names,other_var_vals)
             sample = np.random.choice(np.arange(joint.array.shape[joint_index]),1,p=norm_array_slice)
             #print(sample)
-            current_state_values[index]=sample
+            current_state_values[index]=sample[0]
     return current_state_values
 
 # Gibbs sampling begins by making a random vector of values and then applies the gibbs step repeatedly. 
-def gibbs_sampling(all_factors,known_vars,evidence,N):
+# The markov blankets are made in log space if log=True (or see factors.LOG_SPACE), so big blankets don't underflow.
+def gibbs_sampling(all_factors,known_vars,evidence,N,log=None):
     all_names = []
     # All this below is just to make a general random vector for a factor (and set the evidence)
     for f in all_factors:
@@ -90,7 +96,7 @@ def gibbs_sampling(all_factors,known_vars,evidence,N):
     for i,name in enumerate(all_names):
         for f in all_factors: # find a factor to get the sample
             if(name in f.names):
-                shape = f.array.shape[list(f.names).index(name)]
+                shape = factors.shape_of(f)[list(f.names).index(name)]
                 current_state[i]=np.random.randint(0,shape)
                 break
     for i in range(len(known_vars)):
@@ -102,8 +108,8 @@ def gibbs_sampling(all_factors,known_vars,evidence,N):
         markov_blanket = []
         for f in all_factors:
             if(var_name in f.names):
-                markov_blanket.append(f)
-        all_variable_markov_blankets.append(factors.multiple_factor_product(markov_blanket))
+                markov_blanket.append(factors_sparse.to_dense(f))
+        all_variable_markov_blankets.append(factors.multiple_factor_product(markov_blanket,log))
     
     # This is the core loop
     all_visited_states = []
@@ -112,3 +118,359 @@ def gibbs_sampling(all_factors,known_vars,evidence,N):
         all_visited_states.append(current_state.copy())
     return all_names,np.array(all_visited_states)
     
+
+# BATCH SAMPLING
+# joint_sample_top_down makes one sample per call and works out the order, slices the factors and renormalizes every time.
+# Here that is done once: the factors are put in topological order (parents first, in the same order joint_sample_top_down
+# assigns them) and each one is turned into a table with one row per parent assignment and a cumulative sum along each row.
+# Then N samples are drawn at once, one variable at a time: the parent values of every sample pick out a row of the
+# table (np.ravel_multi_index), and one uniform number per sample picks the value from that row.
+
+# puts the factors of a directed network in an order where parents come before children.
+def topological_order(all_factors):
+    assigned_variable_names = []
+    ordered_factors = []
+    remaining_factors = list(all_factors)
+    while(len(remaining_factors)>0):
+        ready = [f for f in remaining_factors if np.all([i in assigned_variable_names for i in f.names[1:]])]
+        if(len(ready)==0):
+            raise Exception("couldn't find a top down order, the factors need to be a directed graph with the variable first")
+        ordered_factors += ready
+        assigned_variable_names += [f.names[0] for f in ready]
+        remaining_factors = [f for f in remaining_factors if not f in ready]
+    return ordered_factors
+
+# Works out everything the batch samplers need. For each variable (in topological order) this gives:
+# the columns of its parents in the sample array, the number of values of each parent,
+# the normalized table with one row per parent assignment, and the cumulative sum of each row.
+def compile_directed(all_factors):
+    ordered_factors = topological_order(all_factors)
+    names = [f.names[0] for f in ordered_factors]
+    compiled = []
+    for f in ordered_factors:
+        table = factors.to_linear(factors_sparse.to_dense(f)).array
+        # child axis last, then one row per parent assignment.
+        table = np.moveaxis(table,0,-1).reshape(-1,table.shape[0])
+        table = table/np.sum(table,axis=1,keepdims=True)
+        cumulative = np.cumsum(table,axis=1)
+        cumulative[:,-1] = 1 # so rounding can never leave a uniform number above the last value.
+        parent_columns = [names.index(n) for n in f.names[1:]]
+        parent_shape = list(factors.shape_of(f)[1:])
+        compiled.append((parent_columns,parent_shape,table,cumulative))
+    return names,compiled
+
+# the row of the table for each sample, given the parent values in the samples.
+def parent_rows(samples,parent_columns,parent_shape):
+    if(len(parent_columns)==0):
+        return np.zeros(samples.shape[0],dtype=int)
+    return np.ravel_multi_index(tuple(samples[:,parent_columns].T),parent_shape)
+
+# picks the value of each sample from its row of cumulative probabilities.
+def sample_from_rows(cumulative_rows,uniform):
+    return np.sum(uniform[:,None]>cumulative_rows,axis=1)
+
+# draws N joint samples. Returns the names (in the same order as joint_sample_top_down) and an (N, number of variables) array.
+# Pass an np.random.Generator (e.g np.random.default_rng(0)) to get the same samples every time.
+def batch_joint_sample_top_down(all_factors,N,rng=None):
+    if(rng==None):
+        rng = np.random.default_rng()
+    names,compiled = compile_directed(all_factors)
+    samples = np.zeros((N,len(names)),dtype=int)
+    uniform = rng.random((N,len(names)))
+    for k,(parent_columns,parent_shape,table,cumulative) in enumerate(compiled):
+        rows = parent_rows(samples,parent_columns,parent_shape)
+        samples[:,k] = sample_from_rows(cumulative[rows],uniform[:,k])
+    return names,samples
+
+# BATCH LIKELIHOOD WEIGHTING
+# Same as likelihood_weighting_top_down, but N samples at once using the tables from compile_directed.
+# Known variables are set to their evidence and add the log of their table entry to the log weight of each sample.
+# Returns the names, an (N, number of variables) array of samples and the N log weights.
+def batch_likelihood_weighting(all_factors,known_vars,evidence,N,rng=None):
+    if(rng==None):
+        rng = np.random.default_rng()
+    names,compiled = compile_directed(all_factors)
+    samples,log_weights = weighted_samples(names,compiled,known_vars,evidence,N,rng)
+    return names,samples,log_weights
+
+# the sampling part of batch_likelihood_weighting, given the output of compile_directed, so it can be compiled once and reused.
+def weighted_samples(names,compiled,known_vars,evidence,N,rng):
+    samples = np.zeros((N,len(names)),dtype=int)
+    log_weights = np.zeros(N)
+    uniform = rng.random((N,len(names)))
+    for k,(parent_columns,parent_shape,table,cumulative) in enumerate(compiled):
+        rows = parent_rows(samples,parent_columns,parent_shape)
+        if(names[k] in known_vars):
+            evid = evidence[known_vars.index(names[k])]
+            samples[:,k] = evid
+            with np.errstate(divide="ignore"):
+                log_weights += np.log(table[rows,evid])
+        else:
+            samples[:,k] = sample_from_rows(cumulative[rows],uniform[:,k])
+    return samples,log_weights
+
+# the effective sample size of a set of importance weights, (sum of weights)^2 / (sum of weights^2).
+def effective_sample_size(log_weights):
+    weights = np.exp(log_weights-np.max(log_weights))
+    return np.sum(weights)**2/np.sum(weights**2)
+
+# Estimates the posterior over query_vars by likelihood weighting, batch_size samples at a time, up to N samples.
+# If target_ess is given it stops as soon as the effective sample size gets there.
+# The weighted counts are kept relative to the biggest log weight seen so far, so tiny weights don't underflow.
+# Returns the posterior as a Factor, the effective sample size and how many samples were drawn.
+def likelihood_weighting_posterior(all_factors,known_vars,evidence,query_vars,N,batch_size=1000,target_ess=None,rng=None):
+    if(rng==None):
+        rng = np.random.default_rng()
+    names,compiled = compile_directed(all_factors)
+    query_columns = [names.index(n) for n in query_vars]
+    query_shape = [factors.shape_of(f)[0] for n in query_vars for f in all_factors if f.names[0]==n]
+    counts = np.zeros(int(np.prod(query_shape)))
+    shift = -np.inf
+    sum_weights = 0.0
+    sum_squared_weights = 0.0
+    drawn = 0
+    ess = 0.0
+    while(drawn<N):
+        n = min(batch_size,N-drawn)
+        samples,log_weights = weighted_samples(names,compiled,known_vars,evidence,n,rng)
+        drawn += n
+        new_shift = max(shift,np.max(log_weights))
+        if(new_shift==-np.inf):
+            continue # every sample so far has weight 0.
+        # rescale what has been counted so far to the new biggest weight.
+        rescale = np.exp(shift-new_shift)
+        counts *= rescale
+        sum_weights *= rescale
+        sum_squared_weights *= rescale**2
+        shift = new_shift
+        weights = np.exp(log_weights-shift)
+        np.add.at(counts,np.ravel_multi_index(tuple(samples[:,query_columns].T),query_shape),weights)
+        sum_weights += np.sum(weights)
+        sum_squared_weights += np.sum(weights**2)
+        ess = sum_weights**2/sum_squared_weights
+        if(target_ess!=None and ess>=target_ess):
+            break
+    posterior = factors.from_array(list(query_vars),counts.reshape(query_shape))
+    return factors.condition(posterior),ess,drawn
+
+# MULTI CHAIN GIBBS
+# gibbs_step works out slices of the markov blanket factors with python lists every time it updates a variable.
+# Here that is worked out once. Each markov blanket array is flattened, and the position of any assignment in it is the sum of
+# each variable's value times its stride (how far apart neighbouring values of that variable are in the flat array).
+# So for each variable being updated the strides of the other blanket variables are stored, and the values of the variable
+# itself are found at offset + value*stride. With the state of K chains in a (K, number of variables) array, the
+# rows for every chain come from one matrix product and one gather, and every chain is updated at once.
+
+# Works out the markov blankets and strides. Returns the variable names (sorted, like gibbs_sampling), the number of values of
+# each, and for each variable: the flat blanket array, the columns and strides of the other blanket variables and its own stride.
+def compile_gibbs(all_factors,log=None):
+    log = factors.use_log(log,*all_factors)
+    cardinalities = {}
+    for f in all_factors:
+        cardinalities.update(zip(f.names,factors.shape_of(f)))
+    all_names = list(np.unique(list(cardinalities.keys())))
+    compiled = []
+    for var_name in all_names:
+        markov_blanket = [factors_sparse.to_dense(f) for f in all_factors if var_name in f.names]
+        joint = factors.multiple_factor_product(markov_blanket,log)
+        shape = joint.array.shape
+        strides = [int(np.prod(shape[j+1:])) for j in range(len(shape))]
+        other = [j for j in range(len(joint.names)) if joint.names[j]!=var_name]
+        other_columns = [all_names.index(joint.names[j]) for j in other]
+        other_strides = np.array([strides[j] for j in other],dtype=int)
+        var_stride = strides[joint.names.index(var_name)]
+        compiled.append((joint.array.reshape(-1),other_columns,other_strides,var_stride))
+    return all_names,[cardinalities[n] for n in all_names],compiled,log
+
+# runs K chains at once for N sweeps. Returns the names and an (N, K, number of variables) array of states.
+# Pass an np.random.Generator (e.g np.random.default_rng(0)) to get the same chains every time.
+def multi_chain_gibbs_sampling(all_factors,known_vars,evidence,N,K=1,rng=None,log=None):
+    if(rng==None):
+        rng = np.random.default_rng()
+    all_names,cardinalities,compiled,log = compile_gibbs(all_factors,log)
+    states = np.stack([rng.integers(0,c,K) for c in cardinalities],axis=1)
+    for i in range(len(known_vars)):
+        states[:,all_names.index(known_vars[i])] = evidence[i]
+    free = [k for k in range(len(all_names)) if not all_names[k] in known_vars]
+    all_visited_states = np.zeros((N,K,len(all_names)),dtype=int)
+    for n in range(N):
+        for k in free:
+            gibbs_update(states,k,cardinalities[k],compiled[k],log,rng)
+        all_visited_states[n] = states
+    return all_names,all_visited_states
+
+# resamples variable k in every chain from its markov blanket given the other variables.
+def gibbs_update(states,k,cardinality,compiled_k,log,rng):
+    flat_array,other_columns,other_strides,var_stride = compiled_k
+    offsets = states[:,other_columns].dot(other_strides)
+    rows = flat_array[offsets[:,None]+np.arange(cardinality)*var_stride]
+    if(log):
+        rows = np.exp(rows-np.max(rows,axis=1,keepdims=True))
+    cumulative = np.cumsum(rows,axis=1)
+    uniform = rng.random(states.shape[0])*cumulative[:,-1]
+    states[:,k] = np.minimum(np.sum(uniform[:,None]>=cumulative,axis=1),cardinality-1)
+
+# STREAMING GIBBS
+# multi_chain_gibbs_sampling keeps every state, so memory grows with N. gibbs_stream instead yields the (K, number of variables)
+# states one sweep at a time, after burn_in sweeps and then every thin sweeps, for as long as the caller keeps asking.
+# GibbsStatistics keeps running summaries of what it is given, using memory which doesn't grow with the number of states:
+#	marginal counts of each variable and pairwise counts of each pair of variables.
+#	split R-hat across chains. Each chain is split in two halves and R-hat compares the variance within the halves to the
+#	variance between them (close to 1 means converged). The halves are found from running means and variances kept
+#	in blocks of states; when there are too many blocks, neighbouring blocks are merged and the blocks become twice as long.
+#	an autocorrelation based effective sample size. The last max_lag states of each chain are kept to add up the lagged
+#	products, and the autocorrelations are summed until the first negative one.
+# The statistics are on the values of each variable (as numbers). Known variables never change, so their R-hat is 1.
+
+# compiled can be the output of compile_gibbs, if it has already been worked out (all_factors and log are then not used).
+def gibbs_stream(all_factors,known_vars,evidence,K=1,burn_in=0,thin=1,rng=None,log=None,compiled=None):
+    if(rng==None):
+        rng = np.random.default_rng()
+    if(compiled==None):
+        compiled = compile_gibbs(all_factors,log)
+    all_names,cardinalities,compiled,log = compiled
+    states = np.stack([rng.integers(0,c,K) for c in cardinalities],axis=1)
+    for i in range(len(known_vars)):
+        states[:,all_names.index(known_vars[i])] = evidence[i]
+    free = [k for k in range(len(all_names)) if not all_names[k] in known_vars]
+    sweep = 0
+    while(True):
+        for k in free:
+            gibbs_update(states,k,cardinalities[k],compiled[k],log,rng)
+        sweep += 1
+        if(sweep>burn_in and (sweep-burn_in)%thin==0):
+            yield states.copy()
+
+class GibbsStatistics:
+    def __init__(self,all_names,cardinalities,K,max_lag=50,max_blocks=64):
+        self.all_names = list(all_names)
+        self.cardinalities = list(cardinalities)
+        n = len(all_names)
+        largest = max(cardinalities)
+        self.K = K
+        self.T = 0
+        self.counts = np.zeros((n,largest))
+        self.pair_counts = np.zeros((n,n,largest,largest))
+        # running mean and variance (Welford) of the block being filled, and of the finished blocks.
+        self.max_blocks = max_blocks
+        self.block_size = 1
+        self.block_count = 0
+        self.block_mean = np.zeros((K,n))
+        self.block_M2 = np.zeros((K,n))
+        self.blocks = []
+        # sums for the autocorrelations, and the last max_lag states of each chain.
+        self.max_lag = max_lag
+        self.sum_x = np.zeros((K,n))
+        self.sum_x2 = np.zeros((K,n))
+        self.lag_sums = np.zeros((K,max_lag,n))
+        self.history = np.zeros((K,max_lag,n))
+        self.position = 0
+
+    # adds one (K, number of variables) array of states.
+    def update(self,states):
+        K,n = states.shape
+        variables = np.broadcast_to(np.arange(n),(K,n))
+        np.add.at(self.counts,(variables,states),1)
+        np.add.at(self.pair_counts,(variables[:,:,None],variables[:,None,:],states[:,:,None],states[:,None,:]),1)
+        x = states.astype(float)
+        self.T += 1
+        # Welford update of the current block, which is stored once it is full.
+        self.block_count += 1
+        delta = x-self.block_mean
+        self.block_mean += delta/self.block_count
+        self.block_M2 += delta*(x-self.block_mean)
+        if(self.block_count==self.block_size):
+            self.blocks.append((self.block_count,self.block_mean.copy(),self.block_M2.copy()))
+            self.block_count = 0
+            self.block_mean[:] = 0
+            self.block_M2[:] = 0
+            if(len(self.blocks)==self.max_blocks):
+                self.blocks = [merge_moments(self.blocks[b],self.blocks[b+1]) for b in range(0,len(self.blocks),2)]
+                self.block_size *= 2
+        # lagged products with the states max_lag back. The lags not seen yet (at the start) are left out.
+        lags = np.arange(1,self.max_lag+1)
+        lagged = self.history[:,(self.position-lags)%self.max_lag,:]
+        seen = (lags<self.T)[None,:,None]
+        self.lag_sums += x[:,None,:]*lagged*seen
+        self.history[:,self.position,:] = x
+        self.position = (self.position+1)%self.max_lag
+        self.sum_x += x
+        self.sum_x2 += x*x
+
+    # the marginal distribution of a variable, as a Factor.
+    def marginal(self,name):
+        v = self.all_names.index(name)
+        counts = self.counts[v,:self.cardinalities[v]]
+        return factors.from_array([name],counts/np.sum(counts))
+
+    # the joint distribution of two variables, as a Factor.
+    def pairwise(self,name1,name2):
+        v1 = self.all_names.index(name1)
+        v2 = self.all_names.index(name2)
+        counts = self.pair_counts[v1,v2,:self.cardinalities[v1],:self.cardinalities[v2]]
+        return factors.from_array([name1,name2],counts/np.sum(counts))
+
+    # split R-hat of each variable, from the finished blocks (the middle one is left out if there is an odd number).
+    def rhat(self):
+        half = len(self.blocks)//2
+        if(half==0):
+            return np.full(len(self.all_names),np.nan)
+        halves = [combine_moments(self.blocks[:half]),combine_moments(self.blocks[-half:])]
+        n = halves[0][0]
+        means = np.concatenate([h[1] for h in halves],axis=0)
+        variances = np.concatenate([h[2] for h in halves],axis=0)/max(n-1,1)
+        W = np.mean(variances,axis=0)
+        B = n*np.var(means,axis=0,ddof=1)
+        var_hat = (n-1)/n*W+B/n
+        with np.errstate(divide="ignore",invalid="ignore"):
+            rhat = np.sqrt(var_hat/W)
+        rhat[(W==0)&(B==0)] = 1.0
+        return rhat
+
+    # effective sample size of each variable, added up over the chains.
+    def ess(self):
+        T = self.T
+        lags = np.arange(1,self.max_lag+1)
+        mean = self.sum_x/T
+        variance = self.sum_x2/T-mean**2
+        autocovariance = self.lag_sums/np.maximum(T-lags,1)[None,:,None]-mean[:,None,:]**2
+        with np.errstate(divide="ignore",invalid="ignore"):
+            rho = autocovariance/variance[:,None,:]
+        # only the lags before the first negative autocorrelation (and ones which have been seen) count.
+        keep = np.cumprod((rho>0)&(lags<T)[None,:,None],axis=1)
+        ess = T/(1+2*np.sum(np.where(keep,rho,0),axis=1))
+        ess[variance==0] = T
+        return np.sum(ess,axis=0)
+
+# running (count, mean, M2) moments of two blocks merged into one (Chan et al).
+def merge_moments(a,b):
+    count = a[0]+b[0]
+    delta = b[1]-a[1]
+    mean = a[1]+delta*b[0]/count
+    M2 = a[2]+b[2]+delta**2*a[0]*b[0]/count
+    return (count,mean,M2)
+
+def combine_moments(blocks):
+    combined = blocks[0]
+    for b in blocks[1:]:
+        combined = merge_moments(combined,b)
+    return combined
+
+# Runs K chains, streaming states into a GibbsStatistics, until every variable has R-hat below rhat_tolerance
+# (and at least min_ess effective samples, if given), or max_N states have been kept. Checked every check_every states.
+# Returns the statistics and the number of states kept per chain.
+def streaming_gibbs_sampling(all_factors,known_vars,evidence,max_N,K=4,burn_in=100,thin=1,rhat_tolerance=1.01,min_ess=None,check_every=100,rng=None,log=None):
+    compiled = compile_gibbs(all_factors,log)
+    all_names,cardinalities = compiled[:2]
+    statistics = GibbsStatistics(all_names,cardinalities,K)
+    stream = gibbs_stream(all_factors,known_vars,evidence,K,burn_in,thin,rng,compiled=compiled)
+    N = 0
+    for N in range(1,max_N+1):
+        statistics.update(next(stream))
+        if(N%check_every==0):
+            converged = np.all(statistics.rhat()<rhat_tolerance)
+            if(min_ess!=None):
+                converged = converged and np.all(statistics.ess()>=min_ess)
+            if(converged):
+                break
+    return statistics,N
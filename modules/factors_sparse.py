@@ -0,0 +1,207 @@
+import factors
+import numpy as np
+
+# SPARSE FACTORS
+# A lot of factors are mostly zeros, e.g deterministic nodes (logic gates, "caught bus" given "bus is early" and
+# "try to catch the bus") or one-hot encodings. A dense Factor stores every one of those zeros.
+# A SparseFactor only stores the entries which aren't zero (COO format):
+# 1. coords, a 2d array with one row per non zero entry giving the value of each variable.
+#		e.g [[0,1]
+#			 [1,0]]
+# 2. values, the value of each of those entries e.g [0.3,0.7]
+# 3. the names and the number of values of each variable (shape), as the array isn't there to give it.
+# Everything here costs time and memory in proportion to the number of non zero entries, not the size of the table.
+# factors.product, marginalize, condition, drop_variables and sample all hand sparse factors over to the functions here,
+# so sparse factors can be mixed with dense ones in the inference code. A product with a dense factor gives a sparse one.
+# Sparse factors are always probabilities (not log space). Asking for log space turns them into dense factors first.
+# So code written for Factor can still read a sparse answer (e.g factors.product(probs,U).array), array and indexes give
+# the dense versions. array is built again every time it is read, so code which reads it a lot should call to_dense once.
+
+class SparseFactor:
+	__slots__ = ["names","shape","coords","values","_fingerprint"]
+	log = False
+
+	def __init__(self,names,pos_values):
+		self.names = names
+		self.shape = tuple(np.atleast_1d(pos_values).astype(int))
+		self.coords = np.zeros((0,len(names)),dtype=int)
+		self.values = np.zeros(0)
+		self._fingerprint = None
+
+	def __repr__(self):
+		names = self.names
+		name_lengths = [len(str(n)) for n in names]
+		formatter = "".join(["{:<"+str(l+2)+"}" for l in name_lengths])+"{}"
+		strings = [formatter.format(*(list(names)+["Values (10 dp), only non zero shown"]))]
+		for i in np.lexsort(self.coords.T[::-1]):
+			strings.append(formatter.format(*(list(self.coords[i])+[self.values[i].round(10)])))
+		return "".join([s+"\n" for s in strings])
+
+	# the row in coords of the given index, or None if it is zero.
+	def find(self,index):
+		rows = np.nonzero(np.all(self.coords==np.asarray(index),axis=1))[0]
+		if(len(rows)==0):
+			return None
+		return rows[0]
+
+	def get(self,index):
+		row = self.find(index)
+		return 0.0 if row==None else self.values[row]
+
+	# sets a value, adding a new entry if it was zero (and removing it if it becomes zero).
+	def set(self,index,value):
+		if(len(index)!=len(self.names)):
+			raise Exception('length of index is incorrect. Provide {} values'.format(len(self.names)))
+		self._fingerprint = None
+		row = self.find(index)
+		if(row==None):
+			if(value!=0):
+				self.coords = np.concatenate([self.coords,np.array([index],dtype=int)],axis=0)
+				self.values = np.append(self.values,value)
+		elif(value==0):
+			self.coords = np.delete(self.coords,row,axis=0)
+			self.values = np.delete(self.values,row)
+		else:
+			self.values[row] = value
+
+	# the dense array. Changing it doesn't change the factor, use set for that.
+	@property
+	def array(self):
+		array = np.zeros(self.shape)
+		np.add.at(array,tuple(self.coords.T),self.values)
+		return array
+
+	# every combination of values, in the same order as Factor.indexes (zeros included).
+	@property
+	def indexes(self):
+		return np.indices(self.shape).reshape(len(self.shape),int(np.prod(self.shape))).T
+
+	# returns an empty factor with the same names etc.
+	def copy_zeros(self):
+		return SparseFactor(self.names,self.shape)
+
+	def copy(self):
+		return from_coords(self.names,self.shape,self.coords.copy(),self.values.copy())
+
+# makes a sparse factor from arrays of coords and values, without copying them.
+def from_coords(names,shape,coords,values):
+	new_factor = SparseFactor.__new__(SparseFactor)
+	new_factor.names = names
+	new_factor.shape = tuple(shape)
+	new_factor.coords = coords
+	new_factor.values = values
+	new_factor._fingerprint = None
+	return new_factor
+
+# the values are read with flatnonzero rather than array[tuple(coords.T)], which gives the wrong shape for a 0-d array
+# (a factor with no variables left, e.g from contract) and broke products with them.
+def from_dense(factor):
+	if(isinstance(factor,SparseFactor)):
+		return factor
+	array = factors.to_linear(factor).array
+	coords = np.argwhere(array!=0)
+	return from_coords(factor.names,array.shape,coords,array.reshape(-1)[np.flatnonzero(array)])
+
+def to_dense(factor):
+	if(not isinstance(factor,SparseFactor)):
+		return factor
+	return factors.from_array(factor.names,factor.array)
+
+# gives each row of coords a number, the same number for the same row. Returns the numbers and how many different rows there are.
+# Uses np.unique rather than np.ravel_multi_index so it works however big the table would be.
+def row_keys(coords):
+	if(coords.shape[1]==0):
+		return np.zeros(coords.shape[0],dtype=int),1
+	unique_rows,keys = np.unique(coords,axis=0,return_inverse=True)
+	return keys.reshape(-1),unique_rows.shape[0]
+
+# 1. CONDITIONING
+#		Same as factors.condition. A slice with nothing in it (all zeros) is left empty, as filling it in would make the factor dense.
+#		So zero_sums="uniform" can't be done here, use to_dense first.
+def condition(factor,axis="none",zero_sums="nan",in_place=False):
+	if(zero_sums=="uniform"):
+		raise Exception('zero_sums="uniform" would fill in the empty slices of a sparse factor. Use factors_sparse.to_dense first')
+	elif(zero_sums!="nan"):
+		raise Exception('zero_sums must be "nan" or "uniform", not {}'.format(zero_sums))
+	names = factor.names
+	if(axis=="none" or len(axis)==0):
+		cond_var_index = []
+	else:
+		cond_var_index = [a for a in range(len(names)) if names[a] in axis]
+		if(len(cond_var_index)<1):
+			print("Error: couldn't find variable")
+			return None
+	keys,num_keys = row_keys(factor.coords[:,cond_var_index])
+	sums = np.bincount(keys,weights=factor.values,minlength=num_keys)
+	values = factor.values/sums[keys]
+	if(in_place):
+		factor.values = values
+		factor._fingerprint = None
+		return factor
+	return from_coords(names,factor.shape,factor.coords,values)
+
+# 2. MARGINALIZATION
+#		Drops the columns of the summed variables, then adds up the entries which now have the same coords.
+def marginalize(factor,axis="none"):
+	names = factor.names
+	if(axis=="none" or len(axis)==len(names)):
+		return np.sum(factor.values)
+	marg_var_index = [a for a in range(len(names)) if names[a] in axis]
+	if(len(marg_var_index)<1):
+		return None
+	not_marg_var_index = [b for b in range(len(names)) if not b in marg_var_index]
+	kept_coords = factor.coords[:,not_marg_var_index]
+	unique_rows,keys = np.unique(kept_coords,axis=0,return_inverse=True)
+	values = np.bincount(keys.reshape(-1),weights=factor.values,minlength=unique_rows.shape[0])
+	new_names = [names[n] for n in not_marg_var_index]
+	return from_coords(new_names,[factor.shape[n] for n in not_marg_var_index],unique_rows,values)
+
+# 3. PRODUCT
+#		A join on the shared variables. factor2 is sorted by its shared coords, then each entry of factor1 is paired with
+#		the block of factor2 entries with the same shared coords (found with searchsorted). Only non zero pairs are ever made.
+def product(factor1,factor2):
+	factor1 = from_dense(factor1)
+	factor2 = from_dense(factor2)
+	names1 = factor1.names
+	names2 = factor2.names
+	joint_names = [n for n in names1 if n in names2]
+	new_names = names1 + [n for n in names2 if not n in joint_names]
+	shared1 = [names1.index(n) for n in joint_names]
+	shared2 = [names2.index(n) for n in joint_names]
+	extra2 = [i for i in range(len(names2)) if not names2[i] in joint_names]
+	# number the shared coords of both factors together, so equal coords get equal keys.
+	n1 = factor1.coords.shape[0]
+	keys,num_keys = row_keys(np.concatenate([factor1.coords[:,shared1],factor2.coords[:,shared2]],axis=0))
+	keys1 = keys[:n1]
+	keys2 = keys[n1:]
+	order2 = np.argsort(keys2,kind="stable")
+	sorted_keys2 = keys2[order2]
+	start = np.searchsorted(sorted_keys2,keys1,side="left")
+	counts = np.searchsorted(sorted_keys2,keys1,side="right")-start
+	index1 = np.repeat(np.arange(n1),counts)
+	offsets = np.arange(index1.shape[0])-np.repeat(np.cumsum(counts)-counts,counts)
+	index2 = order2[np.repeat(start,counts)+offsets]
+	coords = np.concatenate([factor1.coords[index1],factor2.coords[index2][:,extra2]],axis=1)
+	values = factor1.values[index1]*factor2.values[index2]
+	shape = list(factor1.shape)+[factor2.shape[i] for i in extra2]
+	return from_coords(new_names,shape,coords,values)
+
+# 4. DROP VARIABLES
+#		Keeps the entries which match the values given, without the columns of the dropped variables.
+def drop_variables(factor,axis,values):
+	names = factor.names
+	var_index = [a for a in range(len(names)) if names[a] in axis]
+	if(len(var_index)<1):
+		return factor
+	elif(len(var_index)==len(names)):
+		return None
+	not_var_index = [b for b in range(len(names)) if not b in var_index]
+	set_values = np.array([values[axis.index(names[v])] for v in var_index])
+	match = np.all(factor.coords[:,var_index]==set_values,axis=1)
+	new_names = [names[n] for n in not_var_index]
+	return from_coords(new_names,[factor.shape[n] for n in not_var_index],factor.coords[match][:,not_var_index],factor.values[match])
+
+# samples rows of variable values, only ever picking from the non zero entries.
+def sample(factor,number_of_samples):
+	rows = np.random.choice(np.arange(factor.values.shape[0]),number_of_samples,p=factor.values/np.sum(factor.values))
+	return factor.coords[rows]
@@ -1,4 +1,5 @@
 import numpy as np
+import scipy.sparse
 import matplotlib.pyplot as plt
 import matplotlib.colors as colors
 import matplotlib.animation as animation
@@ -7,173 +8,81 @@ from IPython.display import HTML,Image
 rc('animation', html='html5')
 
 
+# moves as (row change, column change).
+MOVES = {'L':(0,-1),'R':(0,1),'U':(-1,0),'D':(1,0)}
+MATRIX_NAMES = {'L':'left_transition_matrix','R':'right_transition_matrix','U':'up_transition_matrix','D':'down_transition_matrix'}
+
+# the usual action model: each action makes its move with prob_correct_step, otherwise it slips to one of the two sides.
+# An action model is a dict of action name to a list of (move, probability) pairs, any moves and any number of actions.
+def default_action_models(prob_correct_step):
+    prob_misstep = (1.0-prob_correct_step)/2
+    sides = {'L':['U','D'],'R':['U','D'],'D':['R','L'],'U':['R','L']}
+    return dict([(action,[(MOVES[action],prob_correct_step)]+[(MOVES[s],prob_misstep) for s in sides[action]]) for action in ['L','R','U','D']])
+
+# The states are the cells which aren't walls, numbered row by row. state_index is a lookup array the shape of the world
+# giving the state of each cell (-1 for walls), so the state a move lands in is found by shifting the positions of all
+# states at once and looking them up. A move into a wall (or off the grid) stays where it is.
+# Transition matrices are [to,from], one per action, in transition_matrices (and left_transition_matrix etc for L,R,U,D).
+# Moving out of a gold state always goes back to the start.
+# With sparse=True the transition matrices are scipy.sparse CSC matrices. Each column (the state moved from) has one
+# non zero entry per move at most, so they take O(S) memory rather than O(S^2). The solvers in value_iteration and
+# policy_iteration take either kind.
 class Maze:
-    def __init__(self,world,prob_correct_step):
-        prob_correct_step
-        prob_misstep = (1.0-prob_correct_step)/2
-        rows = world.shape[0]
-        cols = world.shape[1]
-        all_possible_positions = []
-        starting_position = []
-        gold_states = []
-        index = 0
-        for row in range(rows):
-            for col in range(cols):
-                if(not world[row,col]=='W'):
-                    all_possible_positions.append([row,col])
-                    if(world[row,col]=='S'):
-                        starting_position = [row,col]
-                    if(world[row,col]=='G'):
-                        gold_states.append(index)
-                    index+=1
-        number_of_states = len(all_possible_positions)
-        
-        def get_position_index(position):
-            for i in range(number_of_states):
-                if(position[0]==all_possible_positions[i][0] and position[1]==all_possible_positions[i][1]):
-                    return i
-            return None
-        
-        initial_state = get_position_index(starting_position)
-        
-        left_transition_matrix = np.zeros((number_of_states,number_of_states))
-        for i in range(number_of_states):
-            pos = all_possible_positions[i]
-            
-            left_pos = [pos[0],pos[1]-1]
-            left_move_index = get_position_index(left_pos)
-            if left_move_index==None:
-                left_transition_matrix[i,i]+=prob_correct_step
-            else:
-                left_transition_matrix[left_move_index,i]+=prob_correct_step
-            
-            up_pos = [pos[0]-1,pos[1]]
-            up_move_index = get_position_index(up_pos)
-            if up_move_index==None:
-                left_transition_matrix[i,i]+=prob_misstep
-            else:
-                left_transition_matrix[up_move_index,i]+=prob_misstep
-            
-            down_pos = [pos[0]+1,pos[1]]
-            down_move_index = get_position_index(down_pos)
-            if down_move_index==None:
-                left_transition_matrix[i,i]+=prob_misstep
-            else:
-                left_transition_matrix[down_move_index,i]+=prob_misstep
-        
-        right_transition_matrix = np.zeros((number_of_states,number_of_states))
-        for i in range(number_of_states):
-            pos = all_possible_positions[i]
-            
-            right_pos = [pos[0],pos[1]+1]
-            right_move_index = get_position_index(right_pos)
-            if right_move_index==None:
-                right_transition_matrix[i,i]+=prob_correct_step
-            else:
-                right_transition_matrix[right_move_index,i]+=prob_correct_step
-            
-            up_pos = [pos[0]-1,pos[1]]
-            up_move_index = get_position_index(up_pos)
-            if up_move_index==None:
-                right_transition_matrix[i,i]+=prob_misstep
-            else:
-                right_transition_matrix[up_move_index,i]+=prob_misstep
-            
-            down_pos = [pos[0]+1,pos[1]]
-            down_move_index = get_position_index(down_pos)
-            if down_move_index==None:
-                right_transition_matrix[i,i]+=prob_misstep
-            else:
-                right_transition_matrix[down_move_index,i]+=prob_misstep
-        
-        down_transition_matrix = np.zeros((number_of_states,number_of_states))
-        for i in range(number_of_states):
-            pos = all_possible_positions[i]
-            
-            down_pos = [pos[0]+1,pos[1]]
-            down_move_index = get_position_index(down_pos)
-            if down_move_index==None:
-                down_transition_matrix[i,i]+=prob_correct_step
-            else:
-                down_transition_matrix[down_move_index,i]+=prob_correct_step
-            
-            right_pos = [pos[0],pos[1]+1]
-            right_move_index = get_position_index(right_pos)
-            if right_move_index==None:
-                down_transition_matrix[i,i]+=prob_misstep
-            else:
-                down_transition_matrix[right_move_index,i]+=prob_misstep
-            
-            left_pos = [pos[0],pos[1]-1]
-            left_move_index = get_position_index(left_pos)
-            if left_move_index==None:
-                down_transition_matrix[i,i]+=prob_misstep
-            else:
-                down_transition_matrix[left_move_index,i]+=prob_misstep
+    def __init__(self,world,prob_correct_step,sparse=False,action_models=None):
+        if(action_models==None):
+            action_models = default_action_models(prob_correct_step)
+        free = world!='W'
+        number_of_states = int(np.sum(free))
+        state_index = np.full(world.shape,-1)
+        state_index[free] = np.arange(number_of_states)
+        positions = np.argwhere(free)
+        initial_state = state_index[tuple(np.argwhere(world=='S')[0])]
+        gold_states = state_index[world=='G']
+        # every move out of a gold state is replaced by going back to the start.
+        from_states = np.nonzero(world[free]!='G')[0]
         
-        up_transition_matrix = np.zeros((number_of_states,number_of_states))
-        for i in range(number_of_states):
-            pos = all_possible_positions[i]
-            
-            up_pos = [pos[0]-1,pos[1]]
-            up_move_index = get_position_index(up_pos)
-            if up_move_index==None:
-                up_transition_matrix[i,i]+=prob_correct_step
-            else:
-                up_transition_matrix[up_move_index,i]+=prob_correct_step
-            
-            right_pos = [pos[0],pos[1]+1]
-            right_move_index = get_position_index(right_pos)
-            if right_move_index==None:
-                up_transition_matrix[i,i]+=prob_misstep
+        self.transition_matrices = {}
+        for action,moves in action_models.items():
+            rows = []
+            cols = []
+            probabilities = []
+            for move,probability in moves:
+                new_positions = positions[from_states]+np.array(move)
+                inside = np.all((new_positions>=0)&(new_positions<np.array(world.shape)),axis=1)
+                to_states = from_states.copy()
+                landed = state_index[tuple(new_positions[inside].T)]
+                to_states[np.nonzero(inside)[0][landed>=0]] = landed[landed>=0]
+                rows.append(to_states)
+                cols.append(from_states)
+                probabilities.append(np.full(len(from_states),probability))
+            rows.append(np.full(len(gold_states),initial_state))
+            cols.append(gold_states)
+            probabilities.append(np.ones(len(gold_states)))
+            if(sparse):
+                matrix = scipy.sparse.coo_matrix((np.concatenate(probabilities),(np.concatenate(rows),np.concatenate(cols))),shape=(number_of_states,number_of_states)).tocsc()
             else:
-                up_transition_matrix[right_move_index,i]+=prob_misstep
-            
-            left_pos = [pos[0],pos[1]-1]
-            left_move_index = get_position_index(left_pos)
-            if left_move_index==None:
-                up_transition_matrix[i,i]+=prob_misstep
-            else:
-                up_transition_matrix[left_move_index,i]+=prob_misstep
-            
-        left_transition_matrix[:,gold_states]=0
-        left_transition_matrix[initial_state,gold_states]=1
-        right_transition_matrix[:,gold_states]=0
-        right_transition_matrix[initial_state,gold_states]=1
-        up_transition_matrix[:,gold_states]=0
-        up_transition_matrix[initial_state,gold_states]=1
-        down_transition_matrix[:,gold_states]=0
-        down_transition_matrix[initial_state,gold_states]=1
-
-        self.left_transition_matrix = left_transition_matrix
-        self.right_transition_matrix = right_transition_matrix
-        self.up_transition_matrix = up_transition_matrix
-        self.down_transition_matrix = down_transition_matrix
-        self.num_states = index
+                matrix = np.zeros((number_of_states,number_of_states))
+                for r,c,p in zip(rows,cols,probabilities):
+                    np.add.at(matrix,(r,c),p)
+            self.transition_matrices[action] = matrix
+            if(action in MATRIX_NAMES):
+                setattr(self,MATRIX_NAMES[action],matrix)
+        self.num_states = number_of_states
         self.world = world
-        self.initial_state = get_position_index(starting_position)
+        self.state_index = state_index
+        self.initial_state = initial_state
     
     def get_reward(self,world_to_dict):
-        index = 0
-        reward = []
-        for row in range(self.world.shape[0]):
-            for col in range(self.world.shape[1]):
-                if(not self.world[row,col]=='W'):
-                    reward.append(world_to_dict[self.world[row,col]])
-        return np.array(reward)
+        symbols,symbol_of_state = np.unique(self.world[self.world!='W'],return_inverse=True)
+        return np.array([world_to_dict[s] for s in symbols])[symbol_of_state.reshape(-1)]
     
     def show_on_map_str(self,values=[], set_W_blank=True):
-        index = 0
         array = self.world.copy().astype('U256')
         size = 4
         if(len(values)>0):
             size = max(4,max([len(str(v)) for v in values])+1)
         if(len(values)>0):
-            for row in range(array.shape[0]):
-                for col in range(array.shape[1]):
-                    if(not array[row,col]=='W'):
-                        array[row,col] = str(values[index])
-                        index+=1
+            array[self.world!='W'] = [str(v) for v in values]
         
         last_row_sizes = np.array([len(v) for v in array[:,-1]])
         max_last_row_size = np.max(last_row_sizes)
@@ -209,27 +118,38 @@ class Maze:
         state_str = self.show_on_map_str(np.arange(self.num_states))
         return world_str + " world map" "\n" + state_str + " state map"
     
+    # the [to,from] transition matrix of following the policy (a list of action names, one per state). Column s is column s
+    # of the matrix of the action taken in s, copied in with one boolean mask per action (as rows of the transpose, so the
+    # writes are contiguous). States with an unknown action (e.g "na") get a zero column.
     def get_policy_matrix(self,policy_vals):        
-        policy_matrix = np.zeros_like(self.left_transition_matrix)
-        for p in range(len(policy_vals)):
-            state_p_policy = policy_vals[p]
-            if(state_p_policy=='U'):
-                policy_matrix[:,p]=self.up_transition_matrix[:,p]
-            if(state_p_policy=='D'):
-                policy_matrix[:,p]=self.down_transition_matrix[:,p]
-            if(state_p_policy=='L'):
-                policy_matrix[:,p]=self.left_transition_matrix[:,p]
-            if(state_p_policy=='R'):
-                policy_matrix[:,p]=self.right_transition_matrix[:,p]        
-        
-        return policy_matrix
+        action_names = list(self.transition_matrices.keys())
+        values,value_of_state = np.unique(np.array(policy_vals),return_inverse=True)
+        action_of_state = np.array([action_names.index(v) if v in action_names else -1 for v in values])[value_of_state.reshape(-1)]
+        if(scipy.sparse.issparse(self.transition_matrices[action_names[0]])):
+            # keep the columns of each action's matrix for the states using that action.
+            policy_matrix = scipy.sparse.csc_matrix((self.num_states,self.num_states))
+            for a,action in enumerate(action_names):
+                policy_matrix = policy_matrix + self.transition_matrices[action] @ scipy.sparse.diags((action_of_state==a).astype(float))
+            return policy_matrix.tocsc()
+        policy_matrix_T = np.zeros((self.num_states,self.num_states))
+        for a,action in enumerate(action_names):
+            in_action = action_of_state==a
+            policy_matrix_T[in_action] = self.transition_matrices[action].T[in_action]
+        return policy_matrix_T.T
     
     def sample_policy(self,transition_matrix,steps):
-        if(not np.isnan(transition_matrix).any()):
+        if(scipy.sparse.issparse(transition_matrix)):
+            has_nan = np.isnan(transition_matrix.data).any()
+            transition_matrix = transition_matrix.tocsc()
+            get_column = lambda i: transition_matrix[:,[i]].toarray().reshape(-1)
+        else:
+            has_nan = np.isnan(transition_matrix).any()
+            get_column = lambda i: transition_matrix[:,i]
+        if(not has_nan):
             state_index = self.initial_state
             state_hist = [state_index]
             for iteration in range(steps):
-                state_index = np.random.choice(transition_matrix.shape[1],p=transition_matrix[:,state_index])
+                state_index = np.random.choice(transition_matrix.shape[1],p=get_column(state_index))
                 state_hist.append(state_index)
             return state_hist
         else:
@@ -1,4 +1,42 @@
 import numpy as np
+import scipy.sparse
+import scipy.sparse.linalg
+import time
+import value_iteration
+
+# the index of each state's action in action_names. The policy can be action names or already indexes.
+def get_policy_index(policy,action_names):
+	policy = np.asarray(policy)
+	if(np.issubdtype(policy.dtype,np.integer)):
+		return policy
+	values,value_of_state = np.unique(policy,return_inverse=True)
+	return np.array([action_names.index(v) for v in values])[value_of_state.reshape(-1)]
+
+# the [to,from] transition matrix of following the policy: column s is column s of the matrix of the action taken in s.
+# For dense matrices the columns of each action are copied in with one boolean mask per action. They are written as rows
+# of the transpose, which keeps the writes contiguous, and the transpose of that is returned (a view, no copy).
+# For scipy.sparse matrices it is built from each action's matrix times a diagonal picking out the states using that action.
+def get_policy_transition(action_transition_dict,policy):
+	action_names = list(action_transition_dict.keys())
+	action_of_state = get_policy_index(policy,action_names)
+	if(any([scipy.sparse.issparse(m) for m in action_transition_dict.values()])):
+		transition = scipy.sparse.csc_matrix((len(action_of_state),len(action_of_state)))
+		for a,action in enumerate(action_names):
+			transition = transition + scipy.sparse.csc_matrix(action_transition_dict[action]) @ scipy.sparse.diags((action_of_state==a).astype(float))
+		return transition.tocsc()
+	transition_T = np.zeros(action_transition_dict[action_names[0]].shape)
+	for a,action in enumerate(action_names):
+		in_action = action_of_state==a
+		transition_T[in_action] = action_transition_dict[action].T[in_action]
+	return transition_T.T
+
+# the transpose of get_policy_transition ([from,to]), from transitions already stacked by value_iteration.stack_transitions.
+# Row s is row s of the stacked matrix of the action taken in s, so it is one fancy indexing gather and the stack isn't copied.
+def gather_policy_transition_T(transitions,action_of_state):
+	states = np.arange(len(action_of_state))
+	if(scipy.sparse.issparse(transitions)):
+		return transitions[action_of_state*len(action_of_state)+states]
+	return transitions[action_of_state,states]
 
 # gets the policies given the value function.
 def get_finite_best_policies(action_transition_dict,utilities,num_steps):
@@ -17,9 +55,7 @@ def get_finite_utilities(action_transition_dict,policies,reward,num_steps):
 	utilities = [reward.copy()] # include the reward for the last policy.
 	num_states = len(reward)
 	for step in reversed(range(num_steps)): # step backward from last policy to first.
-		transition = np.zeros((num_states,num_states))
-		for state in range(num_states):
-			transition[:,state] = action_transition_dict[policies[step][state]][:,state]
+		transition = get_policy_transition(action_transition_dict,policies[step])
 		utility = reward + transition.T.dot(utilities[0]) # as going backward, [0] is the utility of the next states.
 		utilities = [utility] + utilities 
 	return utilities
@@ -42,22 +78,78 @@ def get_infinite_best_policy(action_transition_dict,utility):
 	new_policy = [action_names[d] for d in best_policy]
 	return new_policy
 
+# POLICY EVALUATION
+# The utility of following a policy forever solves u = reward + discount*T^T u, i.e (I-discount*T^T)u = reward. Methods:
+#	"solve": solve that system directly (np.linalg.solve, or spsolve for sparse matrices). No inverse is made.
+#	"iterative": GMRES (scipy.sparse.linalg.gmres), which only needs products with T, so it suits big sparse problems.
+#		It starts from the given utility (e.g the last policy's), which is usually close.
+#	"modified": k backups u = reward + discount*T^T u from the given utility, without solving exactly (modified policy iteration).
+# If the transitions have already been stacked (value_iteration.stack_transitions) they can be passed in to gather from.
+EVALUATION_METHODS = ["solve","iterative","modified"]
+
+def evaluate_policy(action_transition_dict,policy,reward,discount,method="solve",utility=None,k=20,tolerance=1e-10,transitions=None):
+	if(transitions is None):
+		transition_T = get_policy_transition(action_transition_dict,policy).T
+	else:
+		transition_T = gather_policy_transition_T(transitions,get_policy_index(policy,list(action_transition_dict.keys())))
+	if(utility is None):
+		utility = np.zeros(len(reward))
+	if(method=="modified"):
+		if(scipy.sparse.issparse(transition_T)):
+			transition_T = transition_T.tocsr()
+		for i in range(k):
+			utility = reward+discount*transition_T.dot(utility)
+		return utility
+	if(scipy.sparse.issparse(transition_T)):
+		system = scipy.sparse.identity(len(reward),format="csc")-discount*transition_T.tocsc()
+	else:
+		system = np.eye(len(reward))-discount*transition_T
+	if(method=="solve"):
+		if(scipy.sparse.issparse(system)):
+			return scipy.sparse.linalg.spsolve(system,reward)
+		return np.linalg.solve(system,reward)
+	elif(method=="iterative"):
+		utility,info = scipy.sparse.linalg.gmres(system,reward,x0=utility,rtol=tolerance,atol=0)
+		if(info>0):
+			print("GMRES did not converge in",info,"iterations")
+		return utility
+	else:
+		raise Exception('unknown method {}. Use one of {}'.format(method,EVALUATION_METHODS))
+
 def get_infinite_utility(action_transition_dict,policy,reward,discount):
+	return evaluate_policy(action_transition_dict,policy,reward,discount,"solve")
+
+# Policy iteration which stops once the policy doesn't change (and, for "modified", once the utility stops changing too,
+# as k backups don't fully evaluate a policy). The transitions are stacked once. Each evaluation gathers the policy's rows
+# from the stack and each improvement step is one batched product with it.
+# returns the utility, the policy (action names), the number of iterations and the seconds spent evaluating and improving.
+def solve_policy_iteration(action_transition_dict,reward,discount,max_iterations=1000,method="solve",k=20,tolerance=1e-10,policy=None):
+	action_names,transitions = value_iteration.stack_transitions(action_transition_dict)
 	num_states = len(reward)
-	transition = np.zeros((num_states,num_states))
-	for state in range(num_states):
-		transition[:,state] = action_transition_dict[policy[state]][:,state]
-	utility = np.linalg.inv(np.eye(len(reward))-discount*transition.T).dot(reward)
-	return utility
+	if(policy is None):
+		policy = np.random.randint(0,len(action_names),num_states)
+	policy = get_policy_index(policy,action_names)
+	action_utility_matrix = np.zeros((len(action_names),num_states))
+	utility = None
+	timings = {"evaluation":0.0,"improvement":0.0}
+	for iteration in range(1,max_iterations+1):
+		start = time.perf_counter()
+		old_utility = utility
+		utility = evaluate_policy(action_transition_dict,policy,reward,discount,method,utility,k,tolerance,transitions)
+		timings["evaluation"] += time.perf_counter()-start
+		start = time.perf_counter()
+		value_iteration.expected_utilities(transitions,utility,action_utility_matrix)
+		new_policy = np.argmax(action_utility_matrix,axis=0)
+		timings["improvement"] += time.perf_counter()-start
+		stable = np.array_equal(new_policy,policy)
+		policy = new_policy
+		if(stable and (method!="modified" or (old_utility is not None and np.max(np.abs(utility-old_utility))<tolerance))):
+			break
+	return utility,value_iteration.policy_names(policy,action_names),iteration,timings
 
 def run_infinite_policy_iteration(action_transition_dict,reward,discount,iterations):
 	action_names = list(action_transition_dict.keys())
 	num_states = len(reward)
 	policy = [action_names[np.random.randint(0,len(action_names))] for i in range(num_states)]
-	for iteration in range(iterations):
-		utility = get_infinite_utility(action_transition_dict,policy,reward,discount)
-		policy = get_infinite_best_policy(action_transition_dict,utility)
+	utility,policy,num_iterations,timings = solve_policy_iteration(action_transition_dict,reward,discount,iterations,policy=policy)
 	return utility,policy
-
-
-
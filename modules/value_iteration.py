@@ -1,17 +1,73 @@
 import numpy as np
+import scipy.sparse
 
-def value_iteration(rewards_array,action_transition_dict,discount,iterations):
-    current_utility = np.zeros(rewards_array.shape[1])
+# The transition matrices are stored [to,from], one per action. Here they are stacked into one (A,S,S) array of their
+# transposes, [action,from,to], so the expected utility of every action in every state is one batched matmul with the utility.
+# Sparse (scipy.sparse) matrices are stacked on top of each other instead, as one (A*S,S) CSR matrix, so the backup is
+# one sparse matrix vector product and costs O(number of non zeros).
+# returns the action names (in the order of the dict) and the stacked array.
+def stack_transitions(action_transition_dict):
     action_names = list(action_transition_dict.keys())
-    
-    for i in range(iterations):
-        action_utility_matrix = np.zeros((len(action_transition_dict),rewards_array.shape[1]))
-        for a,action in enumerate(action_names):
-            action_utility_matrix[a]=discount*action_transition_dict[action].T.dot(current_utility)+rewards_array[a]
-        current_utility = np.max(action_utility_matrix,axis=0)    
+    if(any([scipy.sparse.issparse(m) for m in action_transition_dict.values()])):
+        transitions = scipy.sparse.vstack([scipy.sparse.csr_matrix(action_transition_dict[action].T) for action in action_names]).tocsr()
+    else:
+        transitions = np.stack([action_transition_dict[action].T for action in action_names])
+    return action_names,transitions
+
+# action_utility_matrix = transitions@utility, for either kind of stacked transitions.
+def expected_utilities(transitions,utility,action_utility_matrix):
+    if(scipy.sparse.issparse(transitions)):
+        action_utility_matrix[:] = (transitions@utility).reshape(action_utility_matrix.shape)
+    else:
+        np.matmul(transitions,utility,out=action_utility_matrix)
+
+# maps an integer policy (one action index per state) to action names.
+def policy_names(policy,action_names):
+    return [action_names[d] for d in policy]
 
-    # now get policy
-    expected_returns = [action_transition_dict[action].T.dot(current_utility) for action in action_names]
-    best_policy = np.argmax(np.concatenate([r.reshape(-1,1) for r in expected_returns],axis=1),axis=1)
-    new_policy = [action_names[d] for d in best_policy]
-    return current_utility,new_policy
+# Value iteration on stacked transitions. Each sweep (Bellman backup) is
+#   Q = rewards + discount*transitions@utility, utility = max over actions of Q
+# written into arrays made once at the start. rewards_array is (A,S), or (S,) for the same reward whatever the action.
+# It stops when the biggest change in utility (the Bellman residual) is below tolerance*(1-discount)/(2*discount),
+# which makes the greedy policy's utility within tolerance of the best possible. tolerance=None runs all max_iterations.
+# returns the utility, the policy as an array of action indexes, the number of sweeps and the residual of each sweep.
+def run_value_iteration(rewards_array,transitions,discount,tolerance=1e-6,max_iterations=10000):
+    if(isinstance(transitions,dict)):
+        transitions = stack_transitions(transitions)[1]
+    num_states = transitions.shape[-1]
+    num_actions = transitions.shape[0]//num_states if scipy.sparse.issparse(transitions) else transitions.shape[0]
+    if(tolerance==None):
+        threshold = -np.inf
+    elif(discount==0):
+        threshold = np.inf
+    else:
+        threshold = tolerance*(1-discount)/(2*discount)
+    action_utility_matrix = np.zeros((num_actions,num_states))
+    current_utility = np.zeros(num_states)
+    new_utility = np.zeros(num_states)
+    residuals = []
+    for i in range(max_iterations):
+        expected_utilities(transitions,current_utility,action_utility_matrix)
+        action_utility_matrix *= discount
+        action_utility_matrix += rewards_array
+        np.max(action_utility_matrix,axis=0,out=new_utility)
+        residuals.append(np.max(np.abs(new_utility-current_utility)))
+        current_utility,new_utility = new_utility,current_utility
+        if(residuals[-1]<threshold):
+            break
+    # the greedy policy for the final utility.
+    expected_utilities(transitions,current_utility,action_utility_matrix)
+    action_utility_matrix *= discount
+    action_utility_matrix += rewards_array
+    policy = np.argmax(action_utility_matrix,axis=0)
+    return current_utility,policy,len(residuals),residuals
+
+# runs a fixed number of sweeps and gives the policy as action names, as before.
+# The policy is picked as before too, by the expected utility of the next state alone (argmax of transitions@utility).
+# That leaves out the reward, so it can differ from run_value_iteration's policy when the reward depends on the action.
+def value_iteration(rewards_array,action_transition_dict,discount,iterations):
+    action_names,transitions = stack_transitions(action_transition_dict)
+    current_utility,policy,num_iterations,residuals = run_value_iteration(rewards_array,transitions,discount,None,iterations)
+    expected_returns = np.zeros((len(action_names),len(current_utility)))
+    expected_utilities(transitions,current_utility,expected_returns)
+    return current_utility,policy_names(np.argmax(expected_returns,axis=0),action_names)